@@ -0,0 +1,278 @@
+# ASGI front end for the camera endpoints. Uploads are read and responses
+# written on the event loop, so a phone on slow Wi-Fi only costs a
+# coroutine; decoding, inference and encoding run on a bounded pool of
+# threads (torch and PIL release the GIL for the heavy parts). Everything
+# else is the Flask app from serve.py, mounted as is, and responses are
+# byte-for-byte what Flask sends.
+#
+#   python -m pip install uvicorn starlette python-multipart
+#   uvicorn asgi:app --port 8000
+import time
+import uuid
+import base64
+import json
+import functools
+
+import anyio
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+import serve
+from lib import config
+from lib.metrics import span, request_seconds
+
+# At most this many requests are decoding, running models or encoding at once
+inference_limiter = anyio.CapacityLimiter(config.ASGI_INFERENCE_THREADS)
+
+
+def run_in_pool(fn, *args):
+    return anyio.to_thread.run_sync(functools.partial(fn, *args), limiter=inference_limiter)
+
+
+# Takes an admission slot before going to the pool, so requests waiting for
+# one don't hold pool threads and are let in by admission's priorities
+# rather than the limiter's arrival order. Waiting happens on anyio's
+# default threads. Raises serve.Overloaded like serve.py's endpoints.
+async def admit(endpoint):
+    return await anyio.to_thread.run_sync(serve.admission.slot, endpoint)
+
+
+async def run_admitted(endpoint, fn):
+    slot = await admit(endpoint)
+    try:
+        return await run_in_pool(run_holding, slot, fn)
+    finally:
+        slot.release()
+
+
+def run_holding(slot, fn):
+    with serve.admission.holding(slot):
+        return fn()
+
+
+# Flask's own JSON response, so the body is exactly what serve.py sends
+def flask_json(payload, status_code=200, headers=None):
+    with span('encode'):
+        with serve.app.app_context():
+            response = serve.app.json.response(payload)
+    return Response(response.get_data(), status_code=status_code, headers=headers, media_type=response.mimetype)
+
+
+def endpoint(name, needs_models=True):
+    def decorator(f):
+        @functools.wraps(f)
+        async def decorated(request):
+            started_at = time.perf_counter()
+            try:
+                if needs_models and not serve.startup.is_ready:
+                    return flask_json({'success': False, 'message': 'Models are still loading'},
+                                      status_code=503, headers={'Retry-After': '1'})
+                response = await f(request)
+            except serve.Overloaded as e:
+                response = flask_json(serve.busy_payload(e), status_code=503,
+                                      headers={'Retry-After': str(e.retry_after)})
+            except BaseException:
+                request_seconds.observe(time.perf_counter() - started_at, endpoint=name)
+                raise
+            # streamed responses are timed until their last chunk is sent
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = timed_stream(response.body_iterator, started_at, name)
+            else:
+                request_seconds.observe(time.perf_counter() - started_at, endpoint=name)
+            return response
+        return decorated
+    return decorator
+
+
+async def timed_stream(chunks, started_at, name):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        request_seconds.observe(time.perf_counter() - started_at, endpoint=name)
+
+
+# Same body formats as serve.request_image_data. Returns a read_data
+# function for the serve.py *_upload functions, which raises if the
+# upload couldn't be read so the error is reported like Flask does.
+async def request_image_data(request):
+    try:
+        mimetype = request.headers.get('content-type', '').split(';')[0].strip()
+        if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+            data = await request.body()
+        elif mimetype == 'multipart/form-data':
+            form = await request.form()
+            data = await form['image'].read()
+        else:
+            body = await request.body()
+            with span('base64_decode'):
+                data = base64.b64decode(json.loads(body)['image'])
+    except Exception as e:
+        error = e
+
+        def read_data():
+            raise error
+        return read_data
+    return lambda: data
+
+
+def request_session_id(request):
+    return request.headers.get('X-Session-Id') or request.query_params.get('session')
+
+
+@endpoint('get_classes')
+async def classes(request):
+    return await run_in_pool(lambda: flask_json(serve.class_names()))
+
+
+@endpoint('capture')
+async def capture(request):
+    read_data = await request_image_data(request)
+    session_id = request_session_id(request)
+    return await run_admitted('capture', lambda: flask_json(serve.capture_upload(read_data, session_id)))
+
+
+@endpoint('detect')
+async def detect(request):
+    read_data = await request_image_data(request)
+    session_id = request_session_id(request)
+    return await run_admitted('detect', lambda: flask_json(serve.detect_upload(read_data, session_id)))
+
+
+@endpoint('classify')
+async def classify(request):
+    read_data = await request_image_data(request)
+    session_id = request_session_id(request)
+    color_id = request.query_params.get('color-id')
+    return await run_admitted('classify', lambda: flask_json(serve.classify_upload(read_data, session_id, color_id)))
+
+
+# Same as serve.classify_stream. Each line is produced on the bounded pool,
+# and the admission slot is released when the stream ends or the client
+# goes away.
+@endpoint('classify_stream')
+async def classify_stream(request):
+    read_data = await request_image_data(request)
+    session_id = request_session_id(request)
+    color_id = request.query_params.get('color-id')
+    slot = await admit('classify')
+    try:
+        slot, lines = await run_in_pool(lambda: serve.classify_stream_upload(read_data(), session_id, color_id, slot))
+    except BaseException:
+        slot.release()
+        raise
+
+    async def body():
+        try:
+            while True:
+                line = await run_in_pool(next, lines, None)
+                if line is None:
+                    break
+                yield line
+        finally:
+            with anyio.CancelScope(shield=True):
+                await run_in_pool(lines.close)
+            slot.release()
+
+    # in case the body never started
+    return StreamingResponse(body(), media_type='application/x-ndjson', headers=serve.STREAM_HEADERS,
+                             background=BackgroundTask(slot.release))
+
+
+# Newest frame wins, like lib.latest_value.LatestValue but for coroutines
+# on one event loop
+class LatestFrame:
+    def __init__(self):
+        self.data = None
+        self.closed = False
+        self.dropped = 0
+        self.event = anyio.Event()
+
+    def put(self, data):
+        if self.data is not None:
+            self.dropped += 1
+        self.data = data
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    async def take(self):
+        while self.data is None and not self.closed:
+            await self.event.wait()
+            self.event = anyio.Event()
+        data, self.data = self.data, None
+        return data
+
+
+# Same protocol as serve.detect_stream
+async def detect_stream(websocket):
+    await websocket.accept()
+    ready = await anyio.to_thread.run_sync(serve.startup.ready.wait, 30)
+    if not ready:
+        await websocket.close(code=1013, reason='Models are still loading')
+        return
+
+    session = serve.sessions.get(websocket.query_params.get('session') or str(uuid.uuid4()))
+    frames = LatestFrame()
+
+    async def receive_frames():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                # text messages are reserved for control, only images are frames
+                if message.get('bytes') is not None:
+                    frames.put(message['bytes'])
+        finally:
+            frames.close()
+
+    def process(data):
+        serve.record_upload(session.id, 'detect', data)
+        artifacts = serve.debug_artifacts.begin()
+        try:
+            response = serve.detect_frame(data, session, artifacts)
+        except serve.Overloaded as e:
+            response = serve.busy_payload(e)
+        except Exception as e:
+            artifacts.error = e
+            serve.logger.exception("Streamed detection failed")
+            response = {'success': False,
+                        'message': 'Error processing image: {}'.format(str(e))}
+        finally:
+            serve.debug_artifacts.submit(artifacts)
+        with span('encode'):
+            return json.dumps(response)
+
+    async with anyio.create_task_group() as tasks:
+        tasks.start_soon(receive_frames)
+        while True:
+            data = await frames.take()
+            if data is None:
+                break
+            try:
+                message = await run_admitted('detect', lambda: process(data))
+            except serve.Overloaded as e:
+                message = json.dumps(serve.busy_payload(e))
+            try:
+                await websocket.send_text(message)
+            except (WebSocketDisconnect, RuntimeError):
+                break
+        tasks.cancel_scope.cancel()
+
+
+app = Starlette(routes=[
+    Route('/classes', classes, methods=['GET']),
+    Route('/capture', capture, methods=['POST']),
+    Route('/detect', detect, methods=['POST']),
+    Route('/classify', classify, methods=['POST']),
+    Route('/classify/stream', classify_stream, methods=['POST']),
+    WebSocketRoute('/detect/stream', detect_stream),
+    Mount('/', app=WSGIMiddleware(serve.app)),
+])
@@ -0,0 +1,116 @@
+# Compares an optimized inference backend against the PyTorch checkpoints:
+# how often they agree and how much faster it is.
+#
+#   python backend-benchmark.py --backend onnx --int8
+#
+import sys
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from lib import config
+from lib.backends import BACKENDS, load_model, calibration_image_paths
+
+MODELS = [
+    ('detect', config.DETECTION_MODEL, 'detect'),
+    ('classify', config.CLASSIFICATION_MODEL, 'classify'),
+    ('color', config.COLOR_MODEL, 'classify'),
+]
+
+
+def box_iou(a, b):
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection + 1e-9)
+
+
+# Fraction of reference boxes with a match at IoU >= 0.5 (1.0 if both are empty)
+def detection_agreement(reference, candidate):
+    a = reference.boxes.xyxy.cpu().numpy()
+    b = candidate.boxes.xyxy.cpu().numpy()
+    if len(a) == 0 or len(b) == 0:
+        return float(len(a) == len(b))
+    return float((box_iou(a, b).max(axis=1) >= 0.5).mean())
+
+
+def classification_agreement(reference, candidate):
+    return float(reference.probs.top1 == candidate.probs.top1)
+
+
+def timed_predict(model, image):
+    start = time.perf_counter()
+    result = model.predict(source=image, verbose=False)[0].cpu()
+    return result, time.perf_counter() - start
+
+
+def percentile_ms(values, fraction):
+    return float(np.percentile(values, fraction * 100)) * 1000
+
+
+def compare(name, path, task, images, args):
+    reference = load_model(path, task)
+    candidate = load_model(path, task, backend=args.backend, int8=args.int8,
+                           calibration_dir=args.calibration_dir)
+    agreement_fn = detection_agreement if task == 'detect' else classification_agreement
+
+    # warm up both so lazy initialization isn't timed
+    timed_predict(reference, images[0])
+    timed_predict(candidate, images[0])
+
+    agreements, reference_times, candidate_times = [], [], []
+    for image in images:
+        reference_result, reference_time = timed_predict(reference, image)
+        candidate_result, candidate_time = timed_predict(candidate, image)
+        agreements.append(agreement_fn(reference_result, candidate_result))
+        reference_times.append(reference_time)
+        candidate_times.append(candidate_time)
+
+    return {
+        'model': name,
+        'agreement': float(np.mean(agreements)),
+        'pytorch_p50': percentile_ms(reference_times, 0.50),
+        'pytorch_p95': percentile_ms(reference_times, 0.95),
+        'backend_p50': percentile_ms(candidate_times, 0.50),
+        'backend_p95': percentile_ms(candidate_times, 0.95),
+        'speedup': float(np.median(reference_times) / np.median(candidate_times)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare an inference backend against pytorch')
+    parser.add_argument('--backend', choices=[b for b in BACKENDS if b != 'pytorch'], default='onnx')
+    parser.add_argument('--int8', action='store_true')
+    parser.add_argument('--images', default='tmp/colors', help='directory of test photos')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--calibration-dir', default=config.CALIBRATION_DIR)
+    parser.add_argument('--min-agreement', type=float, default=0.95,
+                        help='exit with an error if any model agrees less often than this')
+    args = parser.parse_args()
+
+    images = [Image.open(path).convert("RGB") for path in calibration_image_paths(args.images, args.limit)]
+    print(f"Comparing {args.backend}{' int8' if args.int8 else ''} against pytorch on {len(images)} images")
+
+    rows = [compare(name, path, task, images, args) for name, path, task in MODELS]
+
+    print(f"{'model':<10}{'agree':>8}{'pt p50':>10}{'pt p95':>10}{'be p50':>10}{'be p95':>10}{'speedup':>9}")
+    for row in rows:
+        print(f"{row['model']:<10}{row['agreement']:>8.1%}"
+              f"{row['pytorch_p50']:>8.1f}ms{row['pytorch_p95']:>8.1f}ms"
+              f"{row['backend_p50']:>8.1f}ms{row['backend_p95']:>8.1f}ms"
+              f"{row['speedup']:>8.2f}x")
+
+    failed = [row['model'] for row in rows if row['agreement'] < args.min_agreement]
+    if failed:
+        print(f"Agreement below {args.min_agreement:.0%} for: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Production server: several worker processes forked from one parent that
+# has already loaded and warmed up the models, so the weights are shared
+# copy-on-write and memory stays roughly flat as workers are added.
+#
+#   python -m pip install gunicorn
+#   WORKERS=4 gunicorn serve:app
+#
+# gthread workers keep the WebSocket at /detect/stream working; each open
+# stream holds one of a worker's WORKER_THREADS.
+import os
+
+from lib import config
+from lib.prefork import threads_per_worker, set_inference_threads, freeze_heap
+
+# Read by serve.py at import. Non-PyTorch backends load per worker: ONNX
+# Runtime and OpenVINO sessions own thread pools that don't survive a fork.
+# lib.config has already read the environment by now, so its value is set
+# directly; the environment variable is for processes started later.
+preload_app = config.INFERENCE_BACKEND == "pytorch"
+config.PRELOAD_MODELS = preload_app
+os.environ["PRELOAD_MODELS"] = "1" if preload_app else "0"
+
+bind = f"0.0.0.0:{config.PORT}"
+workers = config.WORKERS or max(1, (os.cpu_count() or 1) // 2)
+
+# Crops are fetched in a separate request that can land on any worker, so
+# with more than one they have to be on disk where every worker finds them
+if workers > 1 and not config.CROP_STORE_DIR:
+    config.CROP_STORE_DIR = "tmp/crops"
+    os.environ["CROP_STORE_DIR"] = config.CROP_STORE_DIR
+worker_class = "gthread"
+threads = config.WORKER_THREADS
+timeout = config.WORKER_TIMEOUT
+graceful_timeout = 30
+# recycle workers now and then, staggered so they don't all restart at once
+max_requests = config.WORKER_MAX_REQUESTS
+max_requests_jitter = max(1, config.WORKER_MAX_REQUESTS // 10)
+
+
+# Without preloading every worker loads the models itself, so export them
+# once here first instead of having all workers export at the same time
+def on_starting(server):
+    if preload_app or config.STUB_MODELS:
+        return
+    from lib.backends import ensure_exported
+    for path in (config.DETECTION_MODEL, config.CLASSIFICATION_MODEL, config.COLOR_MODEL):
+        ensure_exported(path, config.INFERENCE_BACKEND,
+                        int8=config.INFERENCE_INT8,
+                        calibration_dir=config.CALIBRATION_DIR,
+                        calibration_images=config.CALIBRATION_IMAGES)
+
+
+def when_ready(server):
+    if preload_app:
+        freeze_heap()
+
+
+def post_fork(server, worker):
+    set_inference_threads(threads_per_worker(workers, config.TORCH_THREADS))
@@ -0,0 +1,174 @@
+import math
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+
+
+class Overloaded(Exception):
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"{endpoint} is over capacity, retry in {retry_after}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+# Limits for one endpoint. Lower priority numbers go first when a slot
+# frees up.
+class EndpointLimits:
+    def __init__(self, concurrency, queue, priority=0):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.priority = priority
+
+
+# A slot held past the function that took it, e.g. for a streamed
+# response. release() can be called from every path that ends the
+# request, only the first call counts.
+class Slot:
+    def __init__(self, controller, endpoint):
+        self.controller = controller
+        self.endpoint = endpoint
+        self.started_at = time.monotonic()
+        self.released = False
+        self.lock = threading.Lock()
+
+    def release(self):
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.controller.release(self.endpoint, time.monotonic() - self.started_at)
+
+
+class _Waiter:
+    def __init__(self, endpoint, priority, order):
+        self.endpoint = endpoint
+        self.key = (priority, order)
+
+
+# Admission control in front of inference. At most `slots` requests run at
+# once overall, and each endpoint has its own concurrency and queue limits.
+# A request that would exceed its endpoint's queue, or that waited longer
+# than max_wait, is turned away with Overloaded so the client can back off
+# instead of timing out. Queued requests are admitted by priority, then in
+# arrival order.
+class AdmissionController:
+    def __init__(self, slots, limits, max_wait=10.0):
+        self.slots = slots
+        self.limits = limits
+        self.max_wait = max_wait
+        self.running = {endpoint: 0 for endpoint in limits}
+        self.waiters = []
+        self.admitted = {endpoint: 0 for endpoint in limits}
+        self.rejected = {endpoint: 0 for endpoint in limits}
+        # recent seconds per request, for Retry-After
+        self.service_seconds = {endpoint: 0.5 for endpoint in limits}
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        # the endpoint a front end already admitted the current thread for
+        self.local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.slots > 0
+
+    def can_run(self, endpoint):
+        return (sum(self.running.values()) < self.slots
+                and self.running[endpoint] < self.limits[endpoint].concurrency)
+
+    # The waiter that should go next, of those whose endpoint has room
+    def next_waiter(self):
+        runnable = [waiter for waiter in self.waiters if self.can_run(waiter.endpoint)]
+        return min(runnable, key=lambda waiter: waiter.key) if runnable else None
+
+    def queued(self, endpoint):
+        return sum(1 for waiter in self.waiters if waiter.endpoint == endpoint)
+
+    # Seconds until a slot is likely free, at least 1
+    def retry_after(self, endpoint):
+        limits = self.limits[endpoint]
+        ahead = self.queued(endpoint) + self.running[endpoint]
+        return max(1, math.ceil(self.service_seconds[endpoint] * ahead / max(1, limits.concurrency)))
+
+    def reject(self, endpoint):
+        self.rejected[endpoint] += 1
+        raise Overloaded(endpoint, self.retry_after(endpoint))
+
+    def acquire(self, endpoint):
+        if not self.enabled:
+            return
+        limits = self.limits[endpoint]
+        with self.condition:
+            if not self.waiters and self.can_run(endpoint):
+                self.running[endpoint] += 1
+                self.admitted[endpoint] += 1
+                return
+            if self.queued(endpoint) >= limits.queue:
+                self.reject(endpoint)
+
+            waiter = _Waiter(endpoint, limits.priority, next(self.order))
+            self.waiters.append(waiter)
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while self.next_waiter() is not waiter:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.reject(endpoint)
+                    self.condition.wait(remaining)
+            finally:
+                self.waiters.remove(waiter)
+                # someone else may be next now
+                self.condition.notify_all()
+            self.running[endpoint] += 1
+            self.admitted[endpoint] += 1
+
+    def release(self, endpoint, seconds):
+        if not self.enabled:
+            return
+        with self.condition:
+            self.running[endpoint] -= 1
+            self.service_seconds[endpoint] = 0.8 * self.service_seconds[endpoint] + 0.2 * seconds
+            self.condition.notify_all()
+
+    def slot(self, endpoint):
+        self.acquire(endpoint)
+        return Slot(self, endpoint)
+
+    # Lets code running under a slot taken elsewhere (e.g. asgi.py, which
+    # admits on the event loop) pass admit() for that endpoint without
+    # taking a second slot
+    @contextmanager
+    def holding(self, slot):
+        previous = getattr(self.local, 'endpoint', None)
+        self.local.endpoint = slot.endpoint
+        try:
+            yield
+        finally:
+            self.local.endpoint = previous
+
+    @contextmanager
+    def admit(self, endpoint):
+        if getattr(self.local, 'endpoint', None) == endpoint:
+            yield
+            return
+        self.acquire(endpoint)
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(endpoint, time.monotonic() - started_at)
+
+    def to_dict(self):
+        with self.condition:
+            return {
+                endpoint: {
+                    'running': self.running[endpoint],
+                    'queued': self.queued(endpoint),
+                    'admitted': self.admitted[endpoint],
+                    'rejected': self.rejected[endpoint],
+                    'concurrency': limits.concurrency,
+                    'queue': limits.queue,
+                    'priority': limits.priority,
+                }
+                for endpoint, limits in self.limits.items()
+            }
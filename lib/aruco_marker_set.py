@@ -1,11 +1,10 @@
-import cv2
-import numpy as np
-from cv2 import aruco
-
+from lib.frame import Frame
 from lib.aruco_utils import aruco_ids_to_color_id
 from lib.aruco_marker import ArucoMarker
 
 class ArucoMarkerSet:
+    _detector = None
+
     def __init__(self, markers):
         self.markers = markers
 
@@ -17,12 +16,24 @@ class ArucoMarkerSet:
         markers = [ArucoMarker.from_aruco_detection(id, point) for id, point in zip(ids, aruco_points)]
         return cls(markers)
 
+    # cv2 is imported on first use, it's slow to import
+    @classmethod
+    def detector(cls):
+        if cls._detector is None:
+            from cv2 import aruco
+            dict = aruco.getPredefinedDictionary(aruco.DICT_6X6_100)
+            cls._detector = aruco.ArucoDetector(dict)
+        return cls._detector
+
     @classmethod
     def detect_from_image(cls, image):
-        dict = aruco.getPredefinedDictionary(aruco.DICT_6X6_100)
-        aruco_detector = aruco.ArucoDetector(dict)
-        opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        aruco_points, ids, _ = aruco_detector.detectMarkers(opencv_image)
+        return cls.detect_from_frame(Frame.from_image(image))
+
+    # The detector thresholds grayscale anyway, so it gets the frame's
+    # cached gray copy instead of a fresh color conversion
+    @classmethod
+    def detect_from_frame(cls, frame):
+        aruco_points, ids, _ = cls.detector().detectMarkers(frame.gray())
         return ArucoMarkerSet.from_aruco_detection(ids, aruco_points)
 
     @property
@@ -0,0 +1,150 @@
+import os
+import glob
+import json
+import fcntl
+
+import numpy as np
+from PIL import Image
+
+from lib.startup import model_input_size
+
+BACKENDS = ('pytorch', 'onnx', 'openvino')
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+
+# Loads a checkpoint with the given inference backend. For anything other
+# than pytorch the .pt file is exported next to itself on first use (and
+# again whenever the .pt is newer than the export) and loaded from there.
+def load_model(path, task, backend='pytorch', int8=False, calibration_dir='tmp/colors', calibration_images=200):
+    from ultralytics import YOLO
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {BACKENDS}")
+    if int8 and backend != 'onnx':
+        raise ValueError("int8 quantization is only supported with the onnx backend")
+    if backend == 'pytorch':
+        return YOLO(path, task=task)
+
+    target = ensure_exported(path, backend, int8, calibration_dir, calibration_images)
+
+    with open(metadata_path(target)) as f:
+        metadata = json.load(f)
+    model = YOLO(target, task=metadata['task'])
+    # Exported models don't know the size they were trained at
+    model.overrides['imgsz'] = metadata['imgsz']
+    return model
+
+
+# Exports the checkpoint unless an up to date export exists. Several
+# processes starting at once (e.g. gunicorn workers) take turns on a lock
+# file, so only the first one exports and the others load its files.
+def ensure_exported(path, backend, int8=False, calibration_dir='tmp/colors', calibration_images=200):
+    target = exported_path(path, backend, int8)
+    if not is_stale(target, path):
+        return target
+    with open(f"{target.rstrip('/')}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if is_stale(target, path):
+            export_model(path, backend, int8, calibration_dir, calibration_images)
+    return target
+
+
+def exported_path(path, backend, int8=False):
+    stem = os.path.splitext(path)[0]
+    if backend == 'onnx':
+        return f"{stem}-int8.onnx" if int8 else f"{stem}.onnx"
+    if backend == 'openvino':
+        return f"{stem}_openvino_model"
+    raise ValueError(f"Nothing to export for backend '{backend}'")
+
+
+def metadata_path(target):
+    return f"{target.rstrip('/')}.json"
+
+
+def is_stale(target, source):
+    if not os.path.exists(target) or not os.path.exists(metadata_path(target)):
+        return True
+    return os.path.getmtime(target) < os.path.getmtime(source)
+
+
+def export_model(path, backend, int8=False, calibration_dir='tmp/colors', calibration_images=200):
+    from ultralytics import YOLO
+
+    model = YOLO(path)
+    imgsz = model_input_size(model)
+    # dynamic batch axis so the batching scheduler can use it
+    exported = model.export(format=backend, imgsz=imgsz, dynamic=True)
+
+    target = exported_path(path, backend, int8)
+    if int8:
+        images = calibration_image_paths(calibration_dir, calibration_images)
+        quantize_onnx(exported, target, images, imgsz, letterbox=model.task == 'detect')
+
+    with open(metadata_path(target), 'w') as f:
+        json.dump({'task': model.task, 'imgsz': imgsz, 'int8': int8}, f)
+    return target
+
+
+def calibration_image_paths(directory, limit):
+    paths = []
+    for pattern in IMAGE_PATTERNS:
+        paths.extend(glob.glob(os.path.join(directory, '**', pattern), recursive=True))
+    paths.sort()
+    if not paths:
+        raise ValueError(f"No calibration images found in {directory}")
+    return paths[:limit]
+
+
+# Static int8 post-training quantization with ONNX Runtime, activation
+# ranges calibrated on real photos
+def quantize_onnx(source, target, image_paths, imgsz, letterbox):
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    input_name = onnx.load(source, load_external_data=False).graph.input[0].name
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.paths = iter(image_paths)
+
+        def get_next(self):
+            path = next(self.paths, None)
+            if path is None:
+                return None
+            return {input_name: preprocess(Image.open(path), imgsz, letterbox)}
+
+    quantize_static(
+        source, target, Reader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+    # Keep ultralytics' metadata (names, stride, task) on the quantized model
+    fp32_model = onnx.load(source)
+    int8_model = onnx.load(target)
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, target)
+
+
+# Approximates ultralytics' preprocessing: letterboxed for detection,
+# resized and center cropped for classification. Returns a 1x3xHxW batch.
+def preprocess(image, imgsz, letterbox):
+    image = image.convert("RGB")
+    if letterbox:
+        scale = imgsz / max(image.size)
+        resized = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR)
+        canvas = Image.new("RGB", (imgsz, imgsz), (114, 114, 114))
+        canvas.paste(resized, ((imgsz - resized.width) // 2, (imgsz - resized.height) // 2))
+        image = canvas
+    else:
+        scale = imgsz / min(image.size)
+        image = image.resize((max(imgsz, round(image.width * scale)), max(imgsz, round(image.height * scale))), Image.BILINEAR)
+        left = (image.width - imgsz) // 2
+        top = (image.height - imgsz) // 2
+        image = image.crop((left, top, left + imgsz, top + imgsz))
+    array = np.asarray(image, dtype=np.float32) / 255.0
+    return np.ascontiguousarray(array.transpose(2, 0, 1)[None])
@@ -16,10 +16,10 @@ class BoundingBox:
     @classmethod
     def from_yolo(cls, yolo_box):
         return cls(
-            x1=int(yolo_box.xyxy[0][0].int()),
-            y1=int(yolo_box.xyxy[0][1].int()),
-            x2=int(yolo_box.xyxy[0][2].int()),
-            y2=int(yolo_box.xyxy[0][3].int())
+            x1=int(yolo_box.xyxy[0][0]),
+            y1=int(yolo_box.xyxy[0][1]),
+            x2=int(yolo_box.xyxy[0][2]),
+            y2=int(yolo_box.xyxy[0][3])
         )
 
     @classmethod
@@ -55,9 +55,10 @@ class BoundingBox:
             self._font = ImageFont.truetype(font_path, size=24)
         return self._font
 
-    # TODO: deprecated
     # Given a list of boxes, combine any where the centers
-    # are within threshold pixels of each other
+    # are within threshold pixels of each other. Each box joins the first
+    # combined box near it, in list order; BoxCollection.merge_nearby groups
+    # around the most confident boxes instead and can give different boxes.
     @classmethod
     def combine_nearby(cls, boxes, threshold):
         combined_boxes = []
@@ -116,7 +117,6 @@ class BoundingBox:
     def draw_label(self, draw, text, text_color, swatch_color):
         x = self.x1  # bottom left corner of box, top left of label
         y = self.y2
-        print(BoundingBox.font())
         text_length = BoundingBox.font().getsize(text)[0]
         draw.rectangle(
             ((x, y), (x+25+text_length+25, y+35)), fill='white')
@@ -0,0 +1,190 @@
+import numpy as np
+
+from lib.bounding_box import BoundingBox
+
+# Boxes closer than this to the image edge are probably cut off
+FRAME_MARGIN = 5
+
+
+# All the boxes from one detection as an N x 4 array of x1, y1, x2, y2 with
+# their confidences and classes, so trays with hundreds of parts don't go
+# through a BoundingBox per object. Operations return new collections;
+# iterating yields BoundingBox views for drawing.
+class BoxCollection:
+    def __init__(self, xyxy, conf=None, cls=None):
+        xyxy = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4)
+        self.xyxy = np.concatenate([
+            np.minimum(xyxy[:, :2], xyxy[:, 2:]),
+            np.maximum(xyxy[:, :2], xyxy[:, 2:]),
+        ], axis=1)
+        count = len(self.xyxy)
+        self.conf = np.ones(count) if conf is None else np.asarray(conf, dtype=np.float64).reshape(count)
+        self.cls = np.zeros(count, dtype=np.int64) if cls is None else np.asarray(cls).reshape(count).astype(np.int64)
+
+    # Whole pixel coordinates straight from a YOLO result, truncated the same
+    # way BoundingBox.from_yolo does
+    @classmethod
+    def from_yolo(cls, result):
+        boxes = result.boxes
+        if boxes is None:
+            return cls(np.zeros((0, 4)))
+        boxes = boxes.cpu().numpy()
+        return cls(np.trunc(np.asarray(boxes.xyxy)), boxes.conf, boxes.cls)
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        return cls([[box.x1, box.y1, box.x2, box.y2] for box in boxes])
+
+    def __len__(self):
+        return len(self.xyxy)
+
+    def __iter__(self):
+        for xyxy in self.xyxy.tolist():
+            yield bounding_box(xyxy)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return bounding_box(self.xyxy[index].tolist())
+        return self.select(index)
+
+    def __repr__(self):
+        return f"BoxCollection({len(self)} boxes)"
+
+    # Boolean mask or index array
+    def select(self, index):
+        return BoxCollection(self.xyxy[index], self.conf[index], self.cls[index])
+
+    def with_xyxy(self, xyxy):
+        return BoxCollection(xyxy, self.conf, self.cls)
+
+    @property
+    def widths(self):
+        return self.xyxy[:, 2] - self.xyxy[:, 0]
+
+    @property
+    def heights(self):
+        return self.xyxy[:, 3] - self.xyxy[:, 1]
+
+    @property
+    def areas(self):
+        return self.widths * self.heights
+
+    @property
+    def centers(self):
+        return (self.xyxy[:, :2] + self.xyxy[:, 2:]) / 2
+
+    def touching_frame(self, frame_width, frame_height, margin=FRAME_MARGIN):
+        x1, y1, x2, y2 = self.xyxy.T
+        return (x1 < margin) | (y1 < margin) | (frame_width - x2 < margin) | (frame_height - y2 < margin)
+
+    def inside_frame(self, frame_width, frame_height, margin=FRAME_MARGIN):
+        return self.select(~self.touching_frame(frame_width, frame_height, margin))
+
+    def sorted_by_area(self, descending=True):
+        areas = self.areas
+        order = np.argsort(-areas if descending else areas, kind='stable')
+        return self.select(order)
+
+    # Lengthens the shorter side of every box, see BoundingBox.square
+    def square(self):
+        widths, heights = self.widths, self.heights
+        size = np.maximum(widths, heights)
+        x1 = self.xyxy[:, 0] - (size - widths) / 2
+        y1 = self.xyxy[:, 1] - (size - heights) / 2
+        return self.with_xyxy(np.stack([x1, y1, x1 + size, y1 + size], axis=1))
+
+    # Negative amounts shrink
+    def grow(self, amount):
+        return self.with_xyxy(self.xyxy + np.asarray([-1, -1, 1, 1]) * amount)
+
+    # From one image's pixels to a resized copy's, keeps whole pixels
+    def scale(self, x, y):
+        return self.with_xyxy(np.trunc(self.xyxy * np.asarray([x, y, x, y])))
+
+    def move(self, x, y):
+        return self.with_xyxy(self.xyxy + np.asarray([x, y, x, y]))
+
+    # Smallest box around all of them
+    def bounds(self):
+        if len(self) == 0:
+            return None
+        x1, y1 = self.xyxy[:, :2].min(axis=0).tolist()
+        x2, y2 = self.xyxy[:, 2:].max(axis=0).tolist()
+        return BoundingBox(x1, y1, x2, y2)
+
+    # Mask of boxes that are entirely inside the given BoundingBox
+    def inside(self, box):
+        x1, y1, x2, y2 = self.xyxy.T
+        return (x1 >= box.x1) & (y1 >= box.y1) & (x2 <= box.x2) & (y2 <= box.y2)
+
+    # contains[i, j] is True when box j lies entirely inside box i
+    def contains(self, other=None):
+        other = self if other is None else other
+        a = self.xyxy[:, None, :]
+        b = other.xyxy[None, :, :]
+        return np.all(b[..., :2] >= a[..., :2], axis=-1) & np.all(b[..., 2:] <= a[..., 2:], axis=-1)
+
+    # Pairwise intersection over union, N x M
+    def iou(self, other=None):
+        other = self if other is None else other
+        a = self.xyxy[:, None, :]
+        b = other.xyxy[None, :, :]
+        top_left = np.maximum(a[..., :2], b[..., :2])
+        bottom_right = np.minimum(a[..., 2:], b[..., 2:])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+        union = self.areas[:, None] + other.areas[None, :] - intersection
+        return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+    # NMS-style merge: the most confident remaining box absorbs every box
+    # whose center is within threshold pixels of its own (or which overlaps
+    # it by more than iou_threshold) and grows to cover them. A single pass,
+    # unlike BoundingBox.combine_nearby, which chains boxes in list order.
+    def merge_nearby(self, threshold, iou_threshold=None):
+        if len(self) == 0:
+            return self
+        order = np.argsort(-self.conf, kind='stable')
+        centers = self.centers
+        remaining = np.ones(len(self), dtype=bool)
+        overlaps = self.iou() if iou_threshold is not None else None
+        merged, conf, cls = [], [], []
+        for i in order:
+            if not remaining[i]:
+                continue
+            group = remaining & (np.hypot(*(centers - centers[i]).T) < threshold)
+            if overlaps is not None:
+                group |= remaining & (overlaps[i] > iou_threshold)
+            group[i] = True
+            remaining &= ~group
+            members = self.xyxy[group]
+            merged.append(np.concatenate([members[:, :2].min(axis=0), members[:, 2:].max(axis=0)]))
+            conf.append(self.conf[i])
+            cls.append(self.cls[i])
+        return BoxCollection(np.asarray(merged), conf, cls)
+
+    # Whole pixel crop rectangles, optionally clamped to the frame
+    def crop_boxes(self, frame_width=None, frame_height=None):
+        boxes = np.trunc(self.xyxy).astype(np.int64)
+        if frame_width is not None:
+            boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, frame_width)
+            boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, frame_height)
+        return boxes
+
+    # One PIL crop per box, same result as BoundingBox.crop for each
+    def crop(self, image):
+        return [image.crop(tuple(box)) for box in self.crop_boxes().tolist()]
+
+    # The /detect response: integer x, y, w, h and whether the box is clear
+    # of the frame edges
+    def to_dicts(self, frame_width, frame_height):
+        valid = ~self.touching_frame(frame_width, frame_height)
+        boxes = np.trunc(self.xyxy).astype(np.int64)
+        return [
+            {"x": x1, "y": y1, "w": x2 - x1, "h": y2 - y1, "valid": is_valid}
+            for (x1, y1, x2, y2), is_valid in zip(boxes.tolist(), valid.tolist())
+        ]
+
+
+# A BoundingBox with Python ints for whole pixel coordinates, like
+# BoundingBox.from_yolo gives, and floats only where a box isn't on whole pixels
+def bounding_box(xyxy):
+    return BoundingBox(*(int(v) if v.is_integer() else v for v in xyxy))
@@ -0,0 +1,79 @@
+import os
+import time
+
+from lib.compensate import canonical_part_id
+from lib.db import DATABASE
+
+# bricks.db is stat()ed at most this often to see whether it was replaced
+DATABASE_CHECK_INTERVAL = 1.0
+
+
+class ClassInfo:
+    def __init__(self, index, part_num, name, url):
+        self.index = index
+        self.part_num = part_num
+        self.name = name
+        self.url = url
+
+    def __repr__(self):
+        return f"ClassInfo({self.index}, '{self.part_num}', '{self.name}', '{self.url}')"
+
+
+# Everything the result path needs about each classifier class, resolved
+# once from bricks.db so predictions don't hit the database at all.
+# Indexed by the classification model's class index. model_version is
+# whatever identifies the classification model it was built for.
+class ClassTable:
+    def __init__(self, entries, model_version=None, database=DATABASE):
+        self.entries = entries
+        self.model_version = model_version
+        self.database = database
+        self.database_version = database_version(database)
+        self.checked_at = time.monotonic()
+
+    @classmethod
+    def build(cls, names, db, model_version=None):
+        part_nums = [canonical_part_id(names[index]) for index in range(len(names))]
+        ldraw_ids = db.get_ldraw_ids_for_part_nums(set(part_nums))
+        parts = db.get_parts_by_nums(set(part_nums))
+
+        entries = []
+        for index, part_num in enumerate(part_nums):
+            part = parts.get(part_num)
+            entries.append(ClassInfo(
+                index=index,
+                part_num=part_num,
+                name=part.name if part else '??? mismatched ids',
+                url=f"/images/{ldraw_ids.get(part_num)}.png",
+            ))
+        return cls(entries, model_version, db.path)
+
+    # True once bricks.db was replaced or it's asked about another model.
+    # The database is only checked every DATABASE_CHECK_INTERVAL seconds.
+    def is_stale(self, model_version):
+        if model_version != self.model_version:
+            return True
+
+        now = time.monotonic()
+        if now - self.checked_at < DATABASE_CHECK_INTERVAL:
+            return False
+        self.checked_at = now
+        return database_version(self.database) != self.database_version
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def class_names(names):
+    return tuple(names[i] for i in range(len(names)))
+
+
+def database_version(database):
+    try:
+        stat = os.stat(database)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,124 @@
+import os
+
+# Runtime settings, overridable with environment variables of the same name.
+
+
+def env_str(name, default):
+    return os.environ.get(name, default)
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, "") else int(value)
+
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, "") else float(value)
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+LOG_LEVEL = env_str("LOG_LEVEL", "INFO").upper()
+
+DETECTION_MODEL = env_str("DETECTION_MODEL", "lego-detect-13-7k-more-negatives3.pt")
+CLASSIFICATION_MODEL = env_str("CLASSIFICATION_MODEL", "03-447x.pt")
+COLOR_MODEL = env_str("COLOR_MODEL", "lego-color-10-more-photos-nano.pt")
+
+# Debug images written to tmp/: "off", "every" (every Nth request) or "on-error"
+DEBUG_ARTIFACTS_MODE = env_str("DEBUG_ARTIFACTS_MODE", "every")
+DEBUG_ARTIFACTS_EVERY = env_int("DEBUG_ARTIFACTS_EVERY", 1)
+DEBUG_ARTIFACTS_QUEUE_SIZE = env_int("DEBUG_ARTIFACTS_QUEUE_SIZE", 16)
+DEBUG_ARTIFACTS_DIR = env_str("DEBUG_ARTIFACTS_DIR", "tmp")
+
+# Crop thumbnails served from /crops/<hash>: jpeg, webp or png
+CROP_FORMAT = env_str("CROP_FORMAT", "jpeg")
+CROP_QUALITY = env_int("CROP_QUALITY", 85)
+CROP_MAX_SIZE = env_int("CROP_MAX_SIZE", 256)
+CROP_STORE_MAX_BYTES = env_int("CROP_STORE_MAX_BYTES", 64 * 1024 * 1024)
+# Optional directory so crops outlive restarts and are shared between workers
+CROP_STORE_DIR = env_str("CROP_STORE_DIR", "")
+
+# Cached /detect and /classify responses keyed by upload content
+RESULT_CACHE_SIZE = env_int("RESULT_CACHE_SIZE", 256)
+# Optional on-disk tier, survives restarts
+RESULT_CACHE_DIR = env_str("RESULT_CACHE_DIR", "")
+
+# Live /detect frames whose mean grayscale difference (0-255) from the last
+# processed frame is below the threshold reuse its boxes. 0 disables.
+DETECT_GATE_THRESHOLD = env_float("DETECT_GATE_THRESHOLD", 3.0)
+DETECT_GATE_SIZE = env_int("DETECT_GATE_SIZE", 32)
+MAX_SESSIONS = env_int("MAX_SESSIONS", 256)
+SESSION_TTL = env_int("SESSION_TTL", 600)
+
+# Requests to the same model are gathered into micro-batches, waiting at
+# most BATCH_MAX_WAIT_MS after the first image for others to arrive
+INFERENCE_BATCHING = env_bool("INFERENCE_BATCHING", True)
+BATCH_MAX_WAIT_MS = env_float("BATCH_MAX_WAIT_MS", 5)
+DETECT_BATCH_SIZE = env_int("DETECT_BATCH_SIZE", 4)
+CLASSIFY_BATCH_SIZE = env_int("CLASSIFY_BATCH_SIZE", 32)
+
+# /classify runs as a pipeline of stages (decode, detect, crop, classify,
+# encode) with their own threads, so stages of different requests overlap.
+# Each stage queues at most PIPELINE_QUEUE_SIZE requests.
+CLASSIFY_PIPELINE = env_bool("CLASSIFY_PIPELINE", True)
+PIPELINE_QUEUE_SIZE = env_int("PIPELINE_QUEUE_SIZE", 4)
+PIPELINE_DECODE_WORKERS = env_int("PIPELINE_DECODE_WORKERS", 2)
+PIPELINE_DETECT_WORKERS = env_int("PIPELINE_DETECT_WORKERS", 2)
+PIPELINE_CROP_WORKERS = env_int("PIPELINE_CROP_WORKERS", 1)
+PIPELINE_CLASSIFY_WORKERS = env_int("PIPELINE_CLASSIFY_WORKERS", 2)
+PIPELINE_ENCODE_WORKERS = env_int("PIPELINE_ENCODE_WORKERS", 1)
+# A request that isn't through every stage after this many seconds fails
+PIPELINE_TIMEOUT = env_float("PIPELINE_TIMEOUT", 60.0)
+
+# pytorch, onnx (ONNX Runtime) or openvino. Non-pytorch models are exported
+# next to the .pt checkpoints on first start.
+INFERENCE_BACKEND = env_str("INFERENCE_BACKEND", "pytorch")
+# int8 post-training quantization (onnx only), calibrated on CALIBRATION_DIR
+INFERENCE_INT8 = env_bool("INFERENCE_INT8", False)
+CALIBRATION_DIR = env_str("CALIBRATION_DIR", "tmp/colors")
+CALIBRATION_IMAGES = env_int("CALIBRATION_IMAGES", 200)
+
+# Uploads above this many pixels are decoded downscaled, 0 for no limit
+MAX_INPUT_PIXELS = env_int("MAX_INPUT_PIXELS", 16_000_000)
+
+# Piece colors from the color "model", a "palette" match of the crop, or
+# the model with the palette as a "check" (lego_color_checks_total)
+COLOR_MODE = env_str("COLOR_MODE", "model")
+
+# Serve deterministic stub models instead of the checkpoints (load tests)
+STUB_MODELS = env_bool("STUB_MODELS", False)
+STUB_PIECES = env_int("STUB_PIECES", 5)
+STUB_LATENCY_MS = env_float("STUB_LATENCY_MS", 20)
+STUB_PER_IMAGE_MS = env_float("STUB_PER_IMAGE_MS", 2)
+
+# Save raw uploads per session here so load-test.py can replay them
+RECORD_SESSIONS_DIR = env_str("RECORD_SESSIONS_DIR", "")
+
+# Production server, see gunicorn.conf.py. WORKERS=0 means one per 2 cores,
+# TORCH_THREADS=0 splits the cores evenly between workers.
+PORT = env_int("PORT", 8000)
+WORKERS = env_int("WORKERS", 0)
+WORKER_THREADS = env_int("WORKER_THREADS", 8)
+TORCH_THREADS = env_int("TORCH_THREADS", 0)
+WORKER_MAX_REQUESTS = env_int("WORKER_MAX_REQUESTS", 2000)
+WORKER_TIMEOUT = env_int("WORKER_TIMEOUT", 120)
+# asgi.py: requests decoding, running models or encoding at the same time
+ASGI_INFERENCE_THREADS = env_int("ASGI_INFERENCE_THREADS", 4)
+# Admission control: requests running models at once across endpoints
+# (0 disables it), and per endpoint how many run and how many may queue.
+# Requests that can't queue or wait longer than ADMISSION_MAX_WAIT seconds
+# get a 503 with Retry-After.
+ADMISSION_SLOTS = env_int("ADMISSION_SLOTS", 4)
+ADMISSION_MAX_WAIT = env_float("ADMISSION_MAX_WAIT", 10.0)
+CLASSIFY_CONCURRENCY = env_int("CLASSIFY_CONCURRENCY", 4)
+CLASSIFY_QUEUE = env_int("CLASSIFY_QUEUE", 16)
+DETECT_CONCURRENCY = env_int("DETECT_CONCURRENCY", 2)
+DETECT_QUEUE = env_int("DETECT_QUEUE", 4)
+# Set by gunicorn.conf.py, loads the models in the parent before forking
+PRELOAD_MODELS = env_bool("PRELOAD_MODELS", False)
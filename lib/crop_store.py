@@ -0,0 +1,118 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+MIMETYPES = {
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'png': 'image/png',
+}
+
+
+# In-memory LRU of encoded crop thumbnails keyed by a hash of their content,
+# so responses can reference crops by URL instead of inlining them. With a
+# directory set, crops are also written to disk so they outlive restarts.
+class CropStore:
+    def __init__(self, max_bytes=64 * 1024 * 1024, format='jpeg', quality=85, max_size=256, directory=None):
+        if format not in MIMETYPES:
+            raise ValueError(f"Unsupported crop format '{format}', expected one of {list(MIMETYPES)}")
+        self.max_bytes = max_bytes
+        self.format = format
+        self.quality = quality
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def mimetype(self):
+        return MIMETYPES[self.format]
+
+    # Stores the image (if not already present) and returns its key
+    def put(self, image):
+        thumbnail = image.convert("RGB")
+        if max(thumbnail.size) > self.max_size:
+            thumbnail.thumbnail((self.max_size, self.max_size))
+
+        key = self.key_for(thumbnail)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return key
+
+        data = self.read_disk(key)
+        if data is None:
+            data = self.encode(thumbnail)
+            self.write_disk(key, data)
+        self.remember(key, data)
+        return key
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                return data
+
+        data = self.read_disk(key)
+        if data is not None:
+            self.remember(key, data)
+        return data
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.entries:
+                return True
+        return self.directory is not None and os.path.exists(self.path_for(key))
+
+    def remember(self, key, data):
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = data
+                self.size += len(data)
+                self.evict()
+
+    def key_for(self, image):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{image.width}x{image.height}:{self.format}:{self.quality}:".encode('utf-8'))
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    def encode(self, image):
+        buffer = BytesIO()
+        if self.format == 'png':
+            image.save(buffer, format='PNG')
+        else:
+            image.save(buffer, format=self.format.upper(), quality=self.quality)
+        return buffer.getvalue()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}.{self.format}")
+
+    def read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self.path_for(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_disk(self, key, data):
+        if not self.directory:
+            return
+        path = self.path_for(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, data = self.entries.popitem(last=False)
+            self.size -= len(data)
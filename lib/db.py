@@ -1,19 +1,51 @@
+import os
+import json
 import sqlite3
+import threading
 from sqlite3 import Error
+from urllib.request import pathname2url
 from lib.part import Part
 
 DATABASE = "./bricks.db"
+MMAP_SIZE = 256 * 1024 * 1024
+CACHED_STATEMENTS = 128
 
+# Read-only access to bricks.db. Each thread keeps its own connection and
+# reuses it across requests; connections are reopened after a fork (or a
+# reload()) since SQLite handles can't be shared between processes.
 class Db:
-    def __init__(self, g):
-        self.g = g
+    def __init__(self, path=DATABASE, immutable=True):
+        self.path = path
+        self.immutable = immutable
+        self.local = threading.local()
+        self.generation = 0
 
     def get_conn(self):
-        conn = getattr(self.g, '_conn', None)
-        if conn is None:
-            conn = self.g._database = sqlite3.connect(DATABASE)
+        local = self.local
+        conn = getattr(local, 'conn', None)
+        if conn is None or local.pid != os.getpid() or local.generation != self.generation:
+            if conn is not None and local.pid == os.getpid():
+                conn.close()
+            conn = local.conn = self.connect()
+            local.pid = os.getpid()
+            local.generation = self.generation
+        return conn
+
+    def connect(self):
+        # immutable=1 skips file locking entirely, bricks.db is never
+        # written while the server is running
+        uri = f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro"
+        if self.immutable:
+            uri += "&immutable=1"
+        conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute("PRAGMA query_only=1")
         return conn
 
+    # Reopen connections on every thread, e.g. after bricks.db was replaced
+    def reload(self):
+        self.generation += 1
+
     def get_part_by_num(self, num):
         c = self.get_conn().cursor()
         c.execute("SELECT part_num, name FROM parts WHERE part_num=?", (num,))
@@ -22,6 +54,15 @@ class Db:
             return None
         return Part.from_db_row(row)
 
+    # Returns {part_num: Part} for the nums that exist
+    def get_parts_by_nums(self, nums):
+        c = self.get_conn().cursor()
+        c.execute("""
+            SELECT part_num, name FROM parts
+            WHERE part_num IN (SELECT value FROM json_each(?))
+        """, (json.dumps(list(nums)),))
+        return {row[0]: Part.from_db_row(row) for row in c.fetchall()}
+
     def get_ldraw_id_for_part_num(self, num):
         c = self.get_conn().cursor()
         sql = """
@@ -38,8 +79,27 @@ class Db:
             return None
         return row[0]
 
+    # Returns {canonical_part_num: ldraw_id} for the nums that have one
+    def get_ldraw_ids_for_part_nums(self, nums):
+        c = self.get_conn().cursor()
+        sql = """
+            select c.canonical_part_num, e.external_id
+            from canonical_parts c
+            left join external_ids e on e.part_num = c.part_num
+            where c.canonical_part_num in (select value from json_each(?))
+            and e."type" = 'LDraw';
+        """
+        c.execute(sql, (json.dumps(list(nums)),))
+        ldraw_ids = {}
+        for num, ldraw_id in c.fetchall():
+            ldraw_ids.setdefault(num, ldraw_id)
+        return ldraw_ids
+
+    # Closes the calling thread's connection
     def close(self):
-        conn = getattr(self.g, '_database', None)
+        conn = getattr(self.local, 'conn', None)
         if conn is None:
             return
-        conn.close()
+        if self.local.pid == os.getpid():
+            conn.close()
+        self.local.conn = None
@@ -0,0 +1,122 @@
+import os
+import queue
+import logging
+import threading
+
+MODES = ("off", "every", "on-error")
+
+logger = logging.getLogger(__name__)
+
+
+# Debug images collected while handling one request. Values are PIL images,
+# raw bytes, or zero-arg callables producing either, so expensive renders
+# (e.g. YOLO result plots) only happen on the writer thread.
+class DebugArtifacts:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.items = []
+        self.error = None
+
+    def add(self, filename, image):
+        if not self.enabled:
+            return
+        # Force the lazy decode now so the writer thread never races the
+        # request thread for the underlying file
+        if hasattr(image, 'load'):
+            image.load()
+        self.items.append((filename, image))
+
+
+# Writes debug artifacts on a background thread. Requests are sampled
+# (off / every Nth request / only requests that errored) and anything that
+# doesn't fit in the bounded queue is dropped rather than blocking. Requests
+# that aren't sampled get a collector that ignores everything, so they
+# don't hold on to images; only on-error has to collect for every request
+# since it can't know up front which ones will fail.
+class DebugArtifactSink:
+    def __init__(self, directory="tmp", mode="every", every=1, queue_size=16):
+        if mode not in MODES:
+            raise ValueError(f"Unknown debug artifact mode '{mode}', expected one of {MODES}")
+        self.directory = directory
+        self.mode = mode
+        self.every = max(1, every)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = None
+        self._pid = None
+
+    def begin(self):
+        return DebugArtifacts(enabled=self.should_sample())
+
+    def submit(self, artifacts):
+        if not artifacts.items:
+            return
+        if self.mode == "on-error" and artifacts.error is None:
+            return
+
+        self.ensure_started()
+        for item in artifacts.items:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                with self.lock:
+                    self.dropped += 1
+
+    def should_sample(self):
+        if self.mode == "off":
+            return False
+        if self.mode == "on-error":
+            return True
+        with self.lock:
+            self.request_count += 1
+            return (self.request_count - 1) % self.every == 0
+
+    # Started lazily (and again after a fork) since threads don't survive fork()
+    def ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="debug-artifacts", daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        self.queue.join()
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _run(self):
+        while True:
+            filename, image = self.queue.get()
+            try:
+                self._write(filename, image)
+                self.written += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Failed to write debug artifact %s", filename)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, filename, image):
+        if callable(image):
+            image = image()
+        path = os.path.join(self.directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            with open(path, 'wb') as f:
+                f.write(image)
+        else:
+            image.convert("RGB").save(path)
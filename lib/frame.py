@@ -0,0 +1,83 @@
+import numpy as np
+from PIL import Image
+
+from lib.metrics import span
+
+# What crops that stick out of the frame are padded with, same as PIL's crop
+PAD_VALUE = 0
+
+
+# One decoded photo as a single contiguous BGR uint8 array, the layout
+# OpenCV and ultralytics both take as is, so ArUco, detection and
+# classification all read the same buffer. Crops are views into it and the
+# grayscale copy is only made once ArUco asks for it.
+class Frame:
+    def __init__(self, bgr):
+        self.bgr = np.ascontiguousarray(bgr, dtype=np.uint8)
+        self._gray = None
+
+    # PIL writes the BGR bytes directly, so this is the only full-size copy
+    @classmethod
+    def from_image(cls, image):
+        with span('frame'):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            data = image.tobytes('raw', 'BGR')
+            return cls(np.frombuffer(data, dtype=np.uint8).reshape(image.height, image.width, 3))
+
+    @property
+    def width(self):
+        return self.bgr.shape[1]
+
+    @property
+    def height(self):
+        return self.bgr.shape[0]
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    # cv2 is imported on first use, it's slow to import
+    def gray(self):
+        if self._gray is None:
+            import cv2
+            self._gray = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    # A view when the box is inside the frame, a padded copy otherwise
+    def crop(self, x1, y1, x2, y2):
+        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+        if x1 >= 0 and y1 >= 0 and x2 <= self.width and y2 <= self.height:
+            return self.bgr[y1:y2, x1:x2]
+
+        crop = np.full((max(0, y2 - y1), max(0, x2 - x1), 3), PAD_VALUE, dtype=np.uint8)
+        src_x1, src_y1 = max(x1, 0), max(y1, 0)
+        src_x2, src_y2 = min(x2, self.width), min(y2, self.height)
+        if src_x2 > src_x1 and src_y2 > src_y1:
+            crop[src_y1 - y1:src_y2 - y1, src_x1 - x1:src_x2 - x1] = self.bgr[src_y1:src_y2, src_x1:src_x2]
+        return crop
+
+    # One crop per box of a BoxCollection
+    def crops(self, boxes):
+        return [self.crop(*box) for box in boxes.crop_boxes().tolist()]
+
+    def image(self):
+        return to_image(self.bgr)
+
+
+# What the models are given: BGR arrays as they are, PIL images as RGB
+def model_input(image):
+    if isinstance(image, Frame):
+        return image.bgr
+    if isinstance(image, np.ndarray):
+        return image
+    return image.convert("RGB")
+
+
+# A PIL image of a frame, a BGR crop or an image, for saving and drawing
+def to_image(image):
+    if isinstance(image, Frame):
+        return image.image()
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(image[..., ::-1]))
+    return image
@@ -0,0 +1,75 @@
+import threading
+import numpy as np
+from PIL import Image
+
+
+class FrameGateStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def to_dict(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+# Skips detection on live frames that barely differ from the last frame we
+# actually ran the model on. Frames are compared as tiny grayscale
+# thumbnails using the mean absolute pixel difference (0-255).
+class FrameGate:
+    def __init__(self, threshold=3.0, size=32, stats=None):
+        self.threshold = threshold
+        self.size = size
+        self.stats = stats or FrameGateStats()
+        self.last_signature = None
+        self.last_result = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def signature(self, image):
+        thumbnail = image.convert("L").resize((self.size, self.size), Image.BILINEAR)
+        return np.asarray(thumbnail, dtype=np.int16)
+
+    # Returns the result for the last processed frame if this frame is
+    # close enough to it, otherwise None
+    def lookup(self, signature):
+        with self.lock:
+            if self.last_signature is None:
+                hit = False
+            else:
+                hit = float(np.abs(signature - self.last_signature).mean()) < self.threshold
+            result = self.last_result if hit else None
+        self.stats.record(hit)
+        return result
+
+    def remember(self, signature, result):
+        with self.lock:
+            self.last_signature = signature
+            self.last_result = result
+
+    # Run compute(image) unless the frame is unchanged since the last run
+    def run(self, image, compute):
+        if not self.enabled:
+            return compute(image)
+
+        signature = self.signature(image)
+        result = self.lookup(signature)
+        if result is None:
+            result = compute(image)
+            self.remember(signature, result)
+        return result
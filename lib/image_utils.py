@@ -1,7 +1,7 @@
 import os
 import base64
 from io import BytesIO
-from PIL import Image, ExifTags
+from PIL import Image
 import hashlib
 import io
 
@@ -12,33 +12,35 @@ def image_to_data_url(image):
     base64_img_data = base64.b64encode(img_data).decode('utf-8')
     return f"data:image/png;base64,{base64_img_data}"
 
-def correct_image_orientation(image):
-    try:
-        # Get the Exif metadata from the image
-        exif_data = image._getexif()
+ORIENTATION_TAG = 0x0112
 
-        # Find the orientation tag in the Exif data
-        for tag, value in ExifTags.TAGS.items():
-            if value == "Orientation":
-                orientation_tag = tag
-                break
+# EXIF orientation to the lossless transpose that displays the image upright
+ORIENTATION_TRANSPOSES = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
 
-        # Get the orientation value
-        orientation = exif_data.get(orientation_tag)
+# Orientations that swap width and height
+SWAPPED_ORIENTATIONS = (5, 6, 7, 8)
 
-        # Rotate the image based on the orientation value
-        if orientation == 3:  # Upside down (180 degrees)
-            image = image.rotate(180, resample=Image.BICUBIC, expand=True)
-        elif orientation == 6:  # 90 degrees clockwise
-            image = image.rotate(270, resample=Image.BICUBIC, expand=True)
-        elif orientation == 8:  # 90 degrees counterclockwise
-            image = image.rotate(90, resample=Image.BICUBIC, expand=True)
+def exif_orientation(image):
+    try:
+        return image.getexif().get(ORIENTATION_TAG, 1)
+    except (AttributeError, KeyError, IndexError, ValueError, SyntaxError):
+        # In case of issues with Exif data, leave the image as it is
+        return 1
 
-    except (AttributeError, KeyError, IndexError):
-        # In case of issues with Exif data, return the original image
-        pass
+def apply_orientation(image, orientation):
+    method = ORIENTATION_TRANSPOSES.get(orientation)
+    return image if method is None else image.transpose(method)
 
-    return image
+def correct_image_orientation(image):
+    return apply_orientation(image, exif_orientation(image))
 
 
 def get_default_font():
@@ -48,10 +50,9 @@ def get_default_font():
         return '/Library/Fonts/Arial.ttf'
 
 def compute_image_hash(image):
-    # Convert the image to bytes
-    byte_array = io.BytesIO()
-    image.save(byte_array, format='PNG')
-
-    # Compute hash using SHA-256
-    hash_object = hashlib.sha256(byte_array.getvalue())
+    # Hash the decoded pixels directly, re-encoding to PNG first
+    # cost more than everything else in the hash
+    hash_object = hashlib.blake2b(digest_size=32)
+    hash_object.update(f"{image.mode}:{image.width}x{image.height}:".encode('utf-8'))
+    hash_object.update(image.tobytes())
     return hash_object.hexdigest()
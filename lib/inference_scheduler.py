@@ -0,0 +1,155 @@
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+
+class _Request:
+    def __init__(self, source):
+        self.source = source
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SchedulerStats:
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.max_batch_size = 0
+        self.waits = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+
+    def record(self, batch, started_at):
+        with self.lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.batch_sizes.append(len(batch))
+            self.waits.extend(started_at - request.enqueued_at for request in batch)
+
+    def to_dict(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            recent_sizes = list(self.batch_sizes)
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'max_batch_size': self.max_batch_size,
+            'mean_batch_size': sum(recent_sizes) / len(recent_sizes) if recent_sizes else 0.0,
+            'wait_ms_p50': percentile(waits, 0.50) * 1000,
+            'wait_ms_p95': percentile(waits, 0.95) * 1000,
+            'wait_ms_max': (waits[-1] if waits else 0.0) * 1000,
+        }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+# Wraps a YOLO model so concurrent callers share forward passes. Images from
+# all callers are queued and a single worker thread runs them in batches of
+# up to max_batch_size, waiting at most max_wait_ms after the first image
+# for others to arrive. Callers get back the same list of results they'd
+# get from model(source) / model.predict(source=...).
+class BatchingModel:
+    def __init__(self, model, name, max_batch_size=8, max_wait_ms=5):
+        self.model = model
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = SchedulerStats()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __call__(self, source=None, **kwargs):
+        return self.predict(source=source, **kwargs)
+
+    def predict(self, source=None, **kwargs):
+        # Anything beyond plain inference isn't batched
+        if kwargs:
+            return self.model.predict(source=source, **kwargs)
+
+        sources = source if isinstance(source, list) else [source]
+        self.ensure_started()
+        requests = [_Request(item) for item in sources]
+        for request in requests:
+            self._queue.put(request)
+        return [request.wait() for request in requests]
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def to_dict(self):
+        return {'queue_depth': self.queue_depth, **self.stats.to_dict()}
+
+    # Started lazily (and again after a fork) since threads don't survive fork()
+    def ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name=f"batch-{self.name}", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started_at = time.monotonic()
+            try:
+                results = self.model.predict(source=[request.source for request in batch])
+                for request, result in zip(batch, results):
+                    request.result = result
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].error = e
+                else:
+                    self._run_one_by_one(batch)
+            finally:
+                self.stats.record(batch, started_at)
+                for request in batch:
+                    request.done.set()
+
+    # After a failed batch, so one bad image only fails its own request
+    def _run_one_by_one(self, batch):
+        for request in batch:
+            try:
+                request.result = self.model.predict(source=[request.source])[0]
+            except Exception as e:
+                request.error = e
+
+    def _next_batch(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
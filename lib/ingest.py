@@ -0,0 +1,79 @@
+import math
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+from lib.frame import Frame
+from lib.image_utils import exif_orientation, apply_orientation, SWAPPED_ORIENTATIONS
+from lib.metrics import span
+
+# Uploads bigger than this are decoded at a reduced size, 0 for no limit
+DEFAULT_MAX_PIXELS = 16_000_000
+
+
+# An uploaded photo that is only decoded as far as each stage needs it.
+# Detection gets a JPEG draft-mode decode just above the model's input
+# size, the full resolution Frame is decoded lazily for the final crops.
+# Both are upright, orientation is applied by lossless transpose, and
+# size is the full image's upright size, which boxes are reported in.
+class IngestedImage:
+    def __init__(self, data, max_pixels=DEFAULT_MAX_PIXELS):
+        self.data = data
+        with span('image_header'):
+            source = Image.open(BytesIO(data))
+        self.format = source.format
+        self.orientation = exif_orientation(source)
+
+        width, height = source.size
+        self.decode_scale = 1.0
+        if max_pixels and width * height > max_pixels:
+            self.decode_scale = math.sqrt(max_pixels / (width * height))
+            width = max(1, int(width * self.decode_scale))
+            height = max(1, int(height * self.decode_scale))
+        self.decode_size = (width, height)
+        self.size = (height, width) if self.orientation in SWAPPED_ORIENTATIONS else (width, height)
+
+        self.reduced_images = {}
+        self.full_frame = None
+        self.lock = threading.Lock()
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    # Decoded so the long side is at least target_size (or the whole image
+    # if that is smaller), cached per size
+    def reduced(self, target_size):
+        with self.lock:
+            image = self.reduced_images.get(target_size)
+            if image is None:
+                image = self.reduced_images[target_size] = self.decode(target_size / max(self.decode_size))
+        return image
+
+    # Only the Frame is kept, not the decoded PIL image
+    def frame(self):
+        with self.lock:
+            if self.full_frame is None:
+                with span('full_decode'):
+                    self.full_frame = Frame.from_image(self.decode(1.0))
+        return self.full_frame
+
+    # Scale is relative to decode_size
+    def decode(self, scale):
+        with span('image_decode'):
+            image = Image.open(BytesIO(self.data))
+            if scale < 1 or self.decode_scale < 1:
+                width, height = self.decode_size
+                # draft picks the largest JPEG DCT scaling that is still at
+                # least this big, it's a no-op for other formats
+                image.draft('RGB', (math.ceil(width * min(scale, 1)), math.ceil(height * min(scale, 1))))
+            image.load()
+            if self.decode_scale < 1 and (image.width > self.decode_size[0] or image.height > self.decode_size[1]):
+                image = image.resize(self.decode_size, Image.BILINEAR, reducing_gap=2.0)
+        with span('exif_orientation'):
+            return apply_orientation(image, self.orientation)
@@ -0,0 +1,31 @@
+import threading
+
+
+# Single-slot mailbox: put() replaces whatever hasn't been taken yet, so a
+# slow consumer always works on the newest value and stale ones are dropped.
+class LatestValue:
+    def __init__(self):
+        self.value = None
+        self.closed = False
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def put(self, value):
+        with self.condition:
+            if self.value is not None:
+                self.dropped += 1
+            self.value = value
+            self.condition.notify()
+
+    # Blocks until a value is available, returns None once closed
+    def take(self):
+        with self.condition:
+            while self.value is None and not self.closed:
+                self.condition.wait()
+            value, self.value = self.value, None
+            return value
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -1,5 +1,3 @@
-from skimage import color
-from skimage.color import deltaE_ciede2000, rgb2lab
 import numpy as np
 
 class LegoColor:
@@ -7,6 +5,7 @@ class LegoColor:
         self.id = id
         self.name = name
         self.hex_color_code = hex_color_code
+        self._lab = None
 
     def hex(self):
         return self.hex_color_code
@@ -16,16 +15,21 @@ class LegoColor:
         return [int(hex_color[i:i+2], 16) for i in (0, 2, 4)] # [255, 255, 255]
 
     def lab(self):
-        return self.__rgb_array_to_lab(self.rgb())
+        if self._lab is None:
+            self._lab = self.__rgb_array_to_lab(self.rgb())
+        return self._lab
 
     def distance(self, other):
+        from skimage.color import deltaE_ciede2000
         other_lab = other.lab() if isinstance(other, LegoColor) else self.__rgb_array_to_lab(other)
         return deltaE_ciede2000(self.lab(), other_lab)[0][0]
 
     def __repr__(self):
         return f"LegoColor(id={self.id}, name='{self.name}', hex_color_code='{self.hex_color_code}')"
 
+    # skimage is imported on first use, it's slow to import
     def __rgb_array_to_lab(self, rgb_array):
+        from skimage.color import rgb2lab
         return rgb2lab(np.uint8(np.asarray([[rgb_array]])))
 
 
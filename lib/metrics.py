@@ -0,0 +1,167 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Seconds, tuned for per-stage latencies from ~1ms to a few seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield self.name, format_labels(self.labels, key), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(c[0]), c[1], c[2])) for key, c in self.values.items()]
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", format_labels(self.labels, key, [('le', format_value(bound))]), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, key), total
+            yield f"{self.name}_count", format_labels(self.labels, key), count
+
+
+# Reads its values from a callback at scrape time, for stats that other
+# components already keep. fn returns {label_values_tuple: value}.
+class Callback:
+    def __init__(self, type, name, help, labels, fn):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+
+    def samples(self):
+        for key, value in self.fn().items():
+            yield self.name, format_labels(self.labels, key), value
+
+
+# Minimal Prometheus text-format registry
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge_callback(self, name, help, labels, fn):
+        return self.register(Callback('gauge', name, help, labels, fn))
+
+    def counter_callback(self, name, help, labels, fn):
+        return self.register(Callback('counter', name, help, labels, fn))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'lego_stage_seconds', 'Time spent in each stage of the request path', ['stage'])
+request_seconds = registry.histogram(
+    'lego_request_seconds', 'Request latency by endpoint', ['endpoint'])
+boxes_per_image = registry.histogram(
+    'lego_boxes_per_image', 'Pieces detected per image', ['endpoint'],
+    buckets=(0, 1, 2, 5, 10, 15, 25, 50, 100, 250, 500))
+pipeline_wait_seconds = registry.histogram(
+    'lego_pipeline_wait_seconds', 'Time requests wait for each pipeline stage', ['stage'])
+color_checks = registry.counter(
+    'lego_color_checks_total', 'Pieces where the palette match agreed with the color model', ['agree'])
+
+
+_recording = threading.local()
+
+
+# Times a block of code into lego_stage_seconds
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        spans = getattr(_recording, 'spans', None)
+        if spans is not None:
+            spans[stage] = spans.get(stage, 0.0) + elapsed
+
+
+# Also collects the spans finished on this thread into a {stage: seconds}
+# dict, e.g. for benchmarks
+@contextmanager
+def record_spans():
+    previous = getattr(_recording, 'spans', None)
+    spans = _recording.spans = {}
+    try:
+        yield spans
+    finally:
+        _recording.spans = previous
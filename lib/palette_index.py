@@ -0,0 +1,87 @@
+import numpy as np
+
+from lib.lego_colors import lego_colors, lego_colors_by_id
+
+# Pixels lighter and greyer than this in LAB count as the white background
+BACKGROUND_MIN_LIGHTNESS = 80
+BACKGROUND_MAX_CHROMA = 12
+# With fewer piece pixels than this the piece is probably white itself
+MIN_FOREGROUND_FRACTION = 0.02
+# Crops are shrunk to this many pixels on the long side before masking
+SAMPLE_SIZE = 64
+# Nearest palette colors to the median that pixels can vote for
+CANDIDATES = 5
+
+
+# skimage is imported on first use, it's slow to import
+def rgb_to_lab(rgb):
+    from skimage.color import rgb2lab
+    rgb = np.asarray(rgb, dtype=np.uint8)
+    return rgb2lab(rgb.reshape(-1, 1, 3)).reshape(rgb.shape[:-1] + (3,))
+
+
+def deltas(labs, palette_labs):
+    from skimage.color import deltaE_ciede2000
+    return deltaE_ciede2000(labs[:, None, :], palette_labs[None, :, :])
+
+
+# All palette colors as one LAB matrix, so matching a color is a single
+# vectorized CIEDE2000 call instead of a LegoColor.distance loop.
+class PaletteIndex:
+    def __init__(self, colors=lego_colors):
+        self.colors = list(colors)
+        self.labs = rgb_to_lab([color.rgb() for color in self.colors])
+
+    # Restricted to the colors a color model knows, names map class index
+    # to a color id string like the color model's
+    @classmethod
+    def for_names(cls, names):
+        ids = sorted({int(name) for name in names.values()})
+        return cls([lego_colors_by_id[id] for id in ids if id in lego_colors_by_id])
+
+    # Palette indices and distances of the k nearest colors, N x k each
+    def nearest_indices(self, labs, k=1):
+        labs = np.asarray(labs, dtype=np.float64).reshape(-1, 3)
+        distances = deltas(labs, self.labs)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return order, np.take_along_axis(distances, order, axis=1)
+
+    # k nearest palette colors for each LAB color, as (colors, distances)
+    # lists sorted by distance
+    def nearest_lab(self, labs, k=1):
+        order, distances = self.nearest_indices(labs, k)
+        return [
+            ([self.colors[i] for i in row], row_distances)
+            for row, row_distances in zip(order.tolist(), distances.tolist())
+        ]
+
+    def nearest(self, rgb, k=1):
+        return self.nearest_lab(rgb_to_lab(np.asarray(rgb).reshape(-1, 3)), k)
+
+    # Piece pixels of a crop on the white background, as an M x 3 LAB
+    # array. Takes a PIL image or a BGR crop of a Frame.
+    def foreground(self, image):
+        if isinstance(image, np.ndarray):
+            step = max(1, max(image.shape[:2]) // SAMPLE_SIZE)
+            rgb = image[::step, ::step, ::-1]
+        else:
+            image = image.convert('RGB')
+            image.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE))
+            rgb = np.asarray(image)
+        labs = rgb_to_lab(rgb).reshape(-1, 3)
+        chroma = np.hypot(labs[:, 1], labs[:, 2])
+        background = (labs[:, 0] > BACKGROUND_MIN_LIGHTNESS) & (chroma < BACKGROUND_MAX_CHROMA)
+        if np.count_nonzero(~background) < MIN_FOREGROUND_FRACTION * len(labs):
+            return labs
+        return labs[~background]
+
+    # Cheap alternative to the color model: the median piece pixel picks a
+    # few candidate colors, every piece pixel votes for its nearest candidate
+    # and the share of votes is the confidence. Returns (LegoColor, confidence).
+    def dominant_color(self, image):
+        labs = self.foreground(image)
+        order, _ = self.nearest_indices(np.median(labs, axis=0), CANDIDATES)
+        candidates = order[0]
+        votes = np.bincount(np.argmin(deltas(labs, self.labs[candidates]), axis=1), minlength=len(candidates))
+        winner = int(np.argmax(votes))
+        return self.colors[candidates[winner]], float(votes[winner] / len(labs))
@@ -0,0 +1,198 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+from lib.inference_scheduler import percentile
+from lib.metrics import pipeline_wait_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    def __init__(self, value, on_done=None):
+        self.value = value
+        self.on_done = on_done
+        self.done = threading.Event()
+        self.error = None
+        self.split = False
+        # parts still going through the stages, see Stage.fan_out
+        self.pending = 1
+        self.lock = threading.Lock()
+
+    # count is -1 for a part through the last stage and len(parts) - 1 when
+    # a fan-out stage splits one; the job is done once none are left
+    def add_parts(self, count):
+        with self.lock:
+            self.pending += count
+            finished = self.pending == 0
+        if finished:
+            self.finish()
+
+    def finish(self):
+        with self.lock:
+            if self.done.is_set():
+                return
+            self.done.set()
+        if self.on_done is not None:
+            self.on_done(self)
+
+    # Raises TimeoutError if the job isn't through every stage in time
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError(f"Pipeline job not done after {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class StageStats:
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.waits = deque(maxlen=window)
+        self.runs = deque(maxlen=window)
+
+    def record(self, wait, seconds, failed):
+        with self.lock:
+            self.items += 1
+            self.errors += failed
+            self.busy_seconds += seconds
+            self.waits.append(wait)
+            self.runs.append(seconds)
+
+    def to_dict(self, workers):
+        with self.lock:
+            waits = sorted(self.waits)
+            runs = list(self.runs)
+            elapsed = time.monotonic() - self.started_at
+            busy_seconds = self.busy_seconds
+        return {
+            'items': self.items,
+            'errors': self.errors,
+            # share of the stage's worker time spent working since it started
+            'utilization': busy_seconds / (workers * elapsed) if elapsed > 0 else 0.0,
+            'run_ms_mean': sum(runs) / len(runs) * 1000 if runs else 0.0,
+            'wait_ms_p50': percentile(waits, 0.50) * 1000,
+            'wait_ms_p95': percentile(waits, 0.95) * 1000,
+            'wait_ms_max': (waits[-1] if waits else 0.0) * 1000,
+        }
+
+
+# One step of a Pipeline: fn takes what the previous stage returned and
+# returns what the next one gets. A fan_out stage returns a list instead,
+# and each item goes through the remaining stages on its own, so parts of
+# one request can be in different stages at once.
+class Stage:
+    def __init__(self, name, fn, workers=1, queue_size=4, fan_out=False):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.fan_out = fan_out
+        self.queue_size = queue_size
+        self.stats = StageStats()
+        self.queue = None
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def to_dict(self):
+        return {
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'queue_depth': self.queue_depth,
+            **self.stats.to_dict(self.workers),
+        }
+
+
+# Runs requests through a fixed sequence of stages, each with its own worker
+# threads, connected by bounded queues. While one request is being
+# classified the next one can already be decoded and detected, so stages
+# from different requests overlap. A full queue blocks the stage before it,
+# and in the end submit(), so a slow stage holds work back instead of
+# piling it up. A stage that raises fails only that request, and run()
+# gives up after timeout seconds so a stuck stage can't hold a request (and
+# its admission slot) forever. run() returns what the last stage returned,
+# or with a fan-out stage, what went into it once every part is through.
+class Pipeline:
+    def __init__(self, name, stages, timeout=None):
+        self.name = name
+        self.stages = stages
+        self.timeout = timeout
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    # on_done(job) is called on the worker thread once the job finished or failed
+    def submit(self, value, on_done=None):
+        self.ensure_started()
+        job = _Job(value, on_done)
+        self.stages[0].queue.put((job, value, time.monotonic()))
+        return job
+
+    def run(self, value):
+        return self.submit(value).wait(self.timeout)
+
+    def to_dict(self):
+        return {stage.name: stage.to_dict() for stage in self.stages}
+
+    # Started lazily (and again after a fork) since threads don't survive fork()
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            for stage in self.stages:
+                stage.queue = queue.Queue(maxsize=stage.queue_size)
+            for i, stage in enumerate(self.stages):
+                following = self.stages[i + 1] if i + 1 < len(self.stages) else None
+                for n in range(stage.workers):
+                    threading.Thread(target=self._run, args=(stage, following),
+                                     name=f"{self.name}-{stage.name}-{n}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self, stage, following):
+        while True:
+            job, value, enqueued_at = stage.queue.get()
+            if job.done.is_set():
+                # another part of it already failed
+                continue
+            started_at = time.monotonic()
+            failed = True
+            try:
+                result = stage.fn(value)
+                failed = False
+            except BaseException as e:
+                job.error = e
+                job.finish()
+                if not isinstance(e, Exception):
+                    # the worker is going away, the job is already failed
+                    logger.error("Pipeline %s stage %s worker exiting: %r", self.name, stage.name, e)
+                    raise
+            finally:
+                finished_at = time.monotonic()
+                pipeline_wait_seconds.observe(started_at - enqueued_at, stage=stage.name)
+                stage.stats.record(started_at - enqueued_at, finished_at - started_at, failed)
+            if failed:
+                continue
+
+            if stage.fan_out:
+                job.split = True
+                parts = list(result)
+            else:
+                if not job.split:
+                    job.value = result
+                parts = [result]
+
+            if following is None:
+                job.add_parts(-1)
+            else:
+                job.add_parts(len(parts) - 1)
+                for part in parts:
+                    following.queue.put((job, part, finished_at))
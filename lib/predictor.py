@@ -1,69 +1,133 @@
-import torch
+import threading
+import numpy as np
 from PIL import Image
 
-from lib.bounding_box import BoundingBox
+from lib.box_collection import BoxCollection
+from lib.frame import model_input, to_image
 from lib.lego_colors import lego_colors_by_id
 from lib.db import Db
 from lib.compensate import canonical_part_id
-
+from lib.class_table import ClassTable, class_names
+from lib.palette_index import PaletteIndex
+from lib.metrics import span, color_checks
+
+# Max crops per classification forward pass
+CLASSIFY_BATCH_SIZE = 32
+# Where piece colors come from: the color "model", the "palette" match of
+# the crop's piece pixels, or the model with the palette as a "check"
+COLOR_MODES = ("model", "palette", "check")
+
+# Highest k probabilities and their class indices. Works on cpu tensors and
+# arrays alike so this module doesn't need to import torch.
+def top_k(probs, k):
+    data = np.asarray(probs.data)
+    indices = np.argsort(-data, kind='stable')[:k]
+    return data[indices], indices
+
+# The color model's top class as (LegoColor, confidence)
+def color_from_result(result):
+    topk_values, topk_indices = top_k(result.probs, 1)
+    predicted_color = lego_colors_by_id[int(result.names[int(topk_indices[0])])]
+    return predicted_color, float(topk_values[0])
+
+# model_version identifies the classification model for the class table,
+# e.g. its checkpoint's fingerprint; by default the model object itself
 class Predictor:
-    def __init__(self, detection_model, classification_model, color_model, db):
+    def __init__(self, detection_model, classification_model, color_model, db, color_mode="model",
+                 model_version=None):
+        if color_mode not in COLOR_MODES:
+            raise ValueError(f"Unknown color mode '{color_mode}', expected one of {COLOR_MODES}")
         self.detection_model = detection_model
         self.classification_model = classification_model
+        # read once, ultralytics builds a new names dict on every access
+        self.class_names = class_names(classification_model.names)
+        self.model_version = model_version if model_version is not None else id(classification_model)
         self.color_model = color_model
         self.db = db
+        self.color_mode = color_mode
+        self.palette = PaletteIndex.for_names(color_model.names) if color_mode != "model" else None
+        self.class_table = None
+        self.class_table_lock = threading.Lock()
 
-    def detect_objects(self, image):
-        results = self.detection_model(image.convert("RGB"))
+    # Takes a PIL image or a Frame. Boxes are in frame_size pixels when the
+    # image is a reduced copy of the frame
+    def detect_objects(self, image, artifacts=None, frame_size=None):
+        with span('detection'):
+            results = self.detection_model(model_input(image))
 
         if len(results) == 0:
-            return []
-
-        Image.fromarray(
-            results[0].cpu().plot()[..., ::-1]
-        ).save('tmp/last-classify-detection.jpeg')
-        boxes = [BoundingBox.from_yolo(yolo_box)
-                    for yolo_box in results[0].cpu().boxes]
-        boxes = list(filter(lambda box: not box.is_touching_frame(
-            image.width, image.height), boxes))
-        boxes.sort(key=lambda box: box.area, reverse=True)
-
-        return boxes
-
-
-    def predict_parts_and_colors(self, image):
-        image.convert("RGB").save('tmp/last-classify-transform.jpg')
-
-        results = self.classification_model.predict(source=image)
+            return BoxCollection([])
 
         result = results[0].cpu()
-        print("---- probs")
-        print(result.probs)
-        print("---- result")
-        print(result)
-        topk_values, topk_indices = torch.topk(result.probs.data, k=3)
-        topk_classes = [result.names[i.item()] for i in topk_indices]
-
-        color_results = self.color_model.predict(source=image.convert("RGB"))
-        color_result = color_results[0].cpu()
-        color_topk_values, topk_indices = torch.topk(color_result.probs.data, k=1)
-        color_topk_classes = [color_result.names[i.item()]
-                                for i in topk_indices]
-        predicted_color = lego_colors_by_id[int(color_topk_classes[0])]
-        predicted_color_confidence = float(color_topk_values[0])
+        if artifacts is not None:
+            artifacts.add('last-classify-detection.jpeg',
+                          lambda: Image.fromarray(result.plot()[..., ::-1]))
+        boxes = BoxCollection.from_yolo(result)
+        width, height = frame_size or image.size
+        if (width, height) != image.size:
+            boxes = boxes.scale(width / image.width, height / image.height)
+        return boxes.inside_frame(width, height).sorted_by_area()
+
+
+    def predict_parts_and_colors(self, image, artifacts=None):
+        return self.predict_parts_and_colors_batch([image], artifacts)[0]
+
+    # Classifies every crop from one photo (PIL images or BGR crops of a
+    # Frame) with a single forward pass per model (chunked so huge trays
+    # don't blow up memory). Returns one list of parts per image, same
+    # shape as predict_parts_and_colors.
+    def predict_parts_and_colors_batch(self, images, artifacts=None):
+        if len(images) == 0:
+            return []
+
+        if artifacts is not None:
+            last_image = images[-1]
+            artifacts.add('last-classify-transform.jpg', lambda: to_image(last_image))
+
+        with span('db'):
+            class_table = self.classes()
+        predictions = []
+        for start in range(0, len(images), CLASSIFY_BATCH_SIZE):
+            chunk = images[start:start + CLASSIFY_BATCH_SIZE]
+            with span('classification'):
+                results = self.classification_model.predict(source=[model_input(image) for image in chunk])
+            colors = self.predict_colors(chunk)
+            for result, (color, color_confidence) in zip(results, colors):
+                predictions.append(self.parts_from_results(result.cpu(), color, color_confidence, class_table))
+
+        return predictions
+
+    # (LegoColor, confidence) for each image, according to color_mode
+    def predict_colors(self, images):
+        if self.color_mode == "palette":
+            with span('color_palette'):
+                return [self.palette.dominant_color(image) for image in images]
+
+        with span('color'):
+            results = self.color_model.predict(source=[model_input(image) for image in images])
+        colors = [color_from_result(result.cpu()) for result in results]
+
+        if self.color_mode == "check":
+            with span('color_palette'):
+                for image, (color, _) in zip(images, colors):
+                    palette_color, _ = self.palette.dominant_color(image)
+                    color_checks.inc(agree="yes" if palette_color.id == color.id else "no")
+        return colors
+
+    def parts_from_results(self, result, predicted_color, predicted_color_confidence, class_table):
+        topk_values, topk_indices = top_k(result.probs, 3)
 
         parts = []
-        for i in range(len(topk_classes)):
-            confidence = topk_values[i].item()
+        for i in range(len(topk_indices)):
+            confidence = float(topk_values[i])
             if confidence < 0.10:
                 continue
-            part_num = canonical_part_id(topk_classes[i])
-            ldraw_id = self.db.get_ldraw_id_for_part_num(part_num)
+            class_info = class_table[int(topk_indices[i])]
 
             parts.append({
-                'id': part_num,
-                'name': self.part_name_or_blank(part_num),
-                'url': f"/images/{ldraw_id}.png",
+                'id': class_info.part_num,
+                'name': class_info.name,
+                'url': class_info.url,
                 'confidence': confidence,
                 'color': {
                     'id': predicted_color.id,
@@ -77,13 +141,26 @@ class Predictor:
         return parts
 
     def predict_color(self, image):
-        results = self.color_model.predict(source=image.convert("RGB"))
-        result = results[0].cpu()
-        topk_values, topk_indices = torch.topk(result.probs.data, k=1)
-        topk_classes = [result.names[i.item()] for i in topk_indices]
-        predicted_color = lego_colors_by_id[int(topk_classes[0])]
-        predicted_confidence = float(topk_values[0])
-        return predicted_color, predicted_confidence
+        return self.predict_colors([image])[0]
+
+    # Metadata for every classifier class, rebuilt when bricks.db or the
+    # classification model changes
+    def classes(self):
+        class_table = self.class_table
+        if class_table is None or class_table.is_stale(self.model_version):
+            with self.class_table_lock:
+                if self.class_table is None or self.class_table.is_stale(self.model_version):
+                    if self.class_table is not None:
+                        self.db.reload()
+                    self.class_table = ClassTable.build(self.class_names, self.db, self.model_version)
+                class_table = self.class_table
+        return class_table
+
+    def reload_classes(self):
+        with self.class_table_lock:
+            self.db.reload()
+            self.class_table = ClassTable.build(self.class_names, self.db, self.model_version)
+        return self.class_table
 
     def part_name_or_blank(self, num):
         part = self.db.get_part_by_num(num)
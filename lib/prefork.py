@@ -0,0 +1,40 @@
+import gc
+import os
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Helpers for running several worker processes forked from one parent that
+# loaded the models (see gunicorn.conf.py). Tensor storage is allocated
+# outside the Python heap and only read during inference, so the children
+# share the parent's copy of the weights until something writes to it.
+
+
+# Cores per worker, so N workers don't each start a thread per core
+def threads_per_worker(workers, threads=0):
+    if threads > 0:
+        return threads
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+# Only touches libraries that are already imported, a worker that never
+# imported torch shouldn't pay for importing it here. Ones imported later
+# pick the limit up from OMP_NUM_THREADS.
+def set_inference_threads(threads):
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(threads)
+    cv2 = sys.modules.get('cv2')
+    if cv2 is not None:
+        cv2.setNumThreads(threads)
+    logger.info("Inference threads: %d", threads)
+
+
+# Moves everything allocated so far out of the collector's reach, so
+# collections in the workers don't write to (and un-share) the parent's
+# object headers
+def freeze_heap():
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# Hash of uploaded bytes plus whatever else the result depends on
+# (endpoint, model versions). blake2b is much faster than sha256 here.
+def cache_key(*parts):
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+# Cheap version string for a set of files (e.g. model checkpoints)
+def file_fingerprint(paths):
+    h = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            h.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size};".encode('utf-8'))
+        except FileNotFoundError:
+            h.update(f"{path}:missing;".encode('utf-8'))
+    return h.hexdigest()
+
+
+class _Pending:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# Caches JSON-able results in an in-memory LRU with an optional on-disk tier
+# that survives restarts. Concurrent requests for the same key are
+# coalesced: one computes, the rest wait for its result.
+class ResultCache:
+    def __init__(self, max_entries=256, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # validate(value) can reject a cached value, e.g. when it references
+    # crops that have since been evicted
+    def get_or_compute(self, key, compute, validate=None):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None and (validate is None or validate(value)):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            pending = self.inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self.inflight[key] = _Pending()
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            value = self.read_disk(key)
+            if value is not None and (validate is None or validate(value)):
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                value = compute()
+                self.write_disk(key, value)
+            self.put(key, value)
+            pending.value = value
+            return value
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            pending.event.set()
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self.path_for(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_disk(self, key, value):
+        if not self.directory:
+            return
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,255 @@
+import logging
+from io import BytesIO
+
+from PIL import Image
+
+from lib.box_collection import BoxCollection
+from lib.image_utils import correct_image_orientation
+from lib.frame import to_image
+from lib.ingest import IngestedImage
+from lib.metrics import span, boxes_per_image
+from lib.pipeline import Pipeline, Stage
+from lib.predictor import CLASSIFY_BATCH_SIZE
+from lib.startup import model_input_size
+from lib.tracker import signatures
+
+logger = logging.getLogger(__name__)
+
+# What the /detect and /classify endpoints do once they have the uploaded
+# bytes, kept free of Flask so benchmarks and other servers can reuse it.
+
+
+def open_image(data):
+    with span('image_decode'):
+        image = Image.open(BytesIO(data))
+        image.load()
+    return image
+
+
+def ingest(data, max_pixels):
+    return IngestedImage(data, max_pixels)
+
+
+def orient(image):
+    with span('exif_orientation'):
+        return correct_image_orientation(image)
+
+
+# Boxes are in the upright upload's pixels, detection only decodes it at
+# about the model's input size
+def detect_boxes(ingested, detection_model, artifacts):
+    image = ingested.reduced(model_input_size(detection_model))
+    artifacts.add('last-detect-original.png', image)
+
+    with span('detection'):
+        results = detection_model(image.convert("RGB"))
+    boxes = BoxCollection([])
+    if len(results) > 0:
+        result = results[0].cpu()
+        boxes = BoxCollection.from_yolo(result)
+        if ingested.size != image.size:
+            boxes = boxes.scale(ingested.width / image.width, ingested.height / image.height)
+        artifacts.add('last-detect-detection.png',
+                      lambda: Image.fromarray(result.plot()[..., ::-1]))
+    boxes_per_image.observe(len(boxes), endpoint='detect')
+
+    return {
+        'width': ingested.width,
+        'height': ingested.height,
+        'boxes': boxes.to_dicts(ingested.width, ingested.height)
+    }
+
+
+# Adds each box's track id, and the parts /classify found for it if the
+# tracker knows the piece, to a /detect response
+def track_boxes(response, tracker):
+    if 'width' not in response:
+        return response
+    boxes = response['boxes']
+    tracks = tracker.update(
+        BoxCollection([[box['x'], box['y'], box['x'] + box['w'], box['y'] + box['h']] for box in boxes]),
+        (response['width'], response['height']))
+
+    tracked = []
+    for box, track in zip(boxes, tracks):
+        box = dict(box, track=track.id)
+        result = tracker.result(track)
+        if result is not None:
+            box['parts'] = result['parts']
+        tracked.append(box)
+    return dict(response, boxes=tracked)
+
+
+def crop_key(url):
+    return url.rsplit('/', 1)[-1]
+
+
+# Chunks of 1, 2, 4, ... items up to max_size, so the first results come
+# back quickly and later ones still share forward passes
+def growing_chunks(items, max_size):
+    start, size = 0, 1
+    while start < len(items):
+        yield items[start:start + size]
+        start += size
+        size = min(size * 2, max_size)
+
+
+# One /classify request. The steps below fill it in one after another,
+# either all on the request thread (classify_events) or each on its own
+# pipeline stage (classify_pipeline). Events for /classify/stream go to
+# on_event as soon as each step produces them: a 'boxes' event with every
+# detected piece (largest first), then an 'object' event per piece.
+# progressive classifies the pieces in growing chunks instead of all at
+# once, trading some batching for time to first result.
+class ClassifyJob:
+    def __init__(self, ingested, artifacts, tracker=None, on_event=None, progressive=False):
+        self.ingested = ingested
+        self.artifacts = artifacts
+        self.tracker = tracker
+        self.on_event = on_event
+        self.progressive = progressive
+        self.boxes = None
+        self.objects = {}
+        self.tracks = []
+        self.signatures = []
+        # indices of the pieces the tracker had no result for
+        self.todo = []
+
+    def emit(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    # The /classify response, once every step has run
+    def response(self):
+        return {
+            'objects': [self.objects[i] for i in range(len(self.boxes))]
+        }
+
+
+# The pieces of a ClassifyJob that are cropped, classified and encoded
+# together. In the pipeline each chunk goes through those stages on its
+# own, so the first chunk's objects are out while later ones still wait.
+class ClassifyChunk:
+    def __init__(self, job, indices, first):
+        self.job = job
+        self.indices = indices
+        self.first = first
+        self.box_images = []
+        self.predictions = []
+
+
+def decode_step(job, predictor):
+    logger.debug("format: %s", job.ingested.format)
+    # the draft decode detection runs on, cached on the image
+    job.ingested.reduced(model_input_size(predictor.detection_model))
+    return job
+
+
+# With a session's tracker, pieces it already classified reuse their
+# result and only new or moved pieces are cropped and classified
+def detect_step(job, predictor, crop_store):
+    ingested = job.ingested
+    detection_image = ingested.reduced(model_input_size(predictor.detection_model))
+    job.boxes = predictor.detect_objects(detection_image, job.artifacts, frame_size=ingested.size)
+    boxes_per_image.observe(len(job.boxes), endpoint='classify')
+    job.emit({'type': 'boxes', 'width': ingested.width, 'height': ingested.height,
+              'boxes': job.boxes.to_dicts(ingested.width, ingested.height)})
+
+    job.todo = list(range(len(job.boxes)))
+    if job.tracker is not None:
+        job.tracks = job.tracker.update(job.boxes, ingested.size)
+        job.signatures = signatures(detection_image, job.boxes, ingested.size)
+        job.todo = []
+        for i, track in enumerate(job.tracks):
+            result = job.tracker.result(track, job.signatures[i])
+            if result is not None and crop_key(result['source_url']) in crop_store:
+                job.objects[i] = dict(result, track=track.id)
+                job.emit(dict(job.objects[i], type='object', index=i))
+            else:
+                job.todo.append(i)
+    return job
+
+
+# No chunks when every piece was reused
+def chunk_step(job):
+    chunks = growing_chunks(job.todo, CLASSIFY_BATCH_SIZE) if job.progressive else [job.todo]
+    return [ClassifyChunk(job, indices, n == 0) for n, indices in enumerate(chunks) if indices]
+
+
+# Only the crops need full resolution
+def crop_step(chunk):
+    job = chunk.job
+    frame = job.ingested.frame()
+    if chunk.first:
+        job.artifacts.add('last-classify-original.jpeg', frame.image)
+    # TODO: square after cropping to avoid snagging other parts
+    with span('cropping'):
+        chunk.box_images = frame.crops(job.boxes.select(chunk.indices).square())
+    return chunk
+
+
+def classify_step(chunk, predictor):
+    chunk.predictions = predictor.predict_parts_and_colors_batch(chunk.box_images, chunk.job.artifacts)
+    return chunk
+
+
+def encode_step(chunk, crop_store):
+    job = chunk.job
+    with span('encode'):
+        for i, box_image, parts in zip(chunk.indices, chunk.box_images, chunk.predictions):
+            result = {
+                'source_url': f"/crops/{crop_store.put(to_image(box_image))}",
+                'parts': parts,
+            }
+            if job.tracks:
+                job.tracker.remember(job.tracks[i], result, job.signatures[i])
+                result = dict(result, track=job.tracks[i].id)
+            job.objects[i] = result
+            job.emit(dict(result, type='object', index=i))
+    return chunk
+
+
+# What /classify does, as a stream of events, on the calling thread
+def classify_events(ingested, predictor, crop_store, artifacts, tracker=None, progressive=False):
+    events = []
+    job = ClassifyJob(ingested, artifacts, tracker, on_event=events.append, progressive=progressive)
+
+    def flush():
+        yield from events
+        events.clear()
+
+    decode_step(job, predictor)
+    detect_step(job, predictor, crop_store)
+    yield from flush()
+
+    for chunk in chunk_step(job):
+        encode_step(classify_step(crop_step(chunk), predictor), crop_store)
+        yield from flush()
+
+
+def classify_objects(ingested, predictor, crop_store, artifacts, tracker=None):
+    job = ClassifyJob(ingested, artifacts, tracker)
+    decode_step(job, predictor)
+    detect_step(job, predictor, crop_store)
+    for chunk in chunk_step(job):
+        encode_step(classify_step(crop_step(chunk), predictor), crop_store)
+    return job.response()
+
+
+# The same steps as pipeline stages, so decoding, detection, cropping,
+# classification and crop encoding of different requests overlap. workers
+# gives the threads per stage by name. Runs ClassifyJobs and returns them
+# with every step done. Detection splits a job into its chunks, which go
+# through the later stages on their own, so a progressive job's first
+# objects are emitted while its later chunks are still being classified.
+def classify_pipeline(predictor, crop_store, workers, queue_size, timeout=None):
+    steps = (
+        ('decode', lambda job: decode_step(job, predictor), False),
+        ('detect', lambda job: chunk_step(detect_step(job, predictor, crop_store)), True),
+        ('crop', crop_step, False),
+        ('classify', lambda chunk: classify_step(chunk, predictor), False),
+        ('encode', lambda chunk: encode_step(chunk, crop_store), False),
+    )
+    return Pipeline('classify', [Stage(name, fn, workers.get(name, 1), queue_size, fan_out)
+                                 for name, fn, fan_out in steps],
+                    timeout=timeout)
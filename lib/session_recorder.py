@@ -0,0 +1,43 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+
+from lib.debug_artifacts import DebugArtifactSink
+
+MAX_SESSIONS = 1024
+
+
+def image_extension(data):
+    head = bytes(data[:12])
+    if head.startswith(b'\xff\xd8'):
+        return 'jpg'
+    if head.startswith(b'\x89PNG'):
+        return 'png'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'webp'
+    return 'bin'
+
+
+# Records the raw uploads of live sessions so load-test.py can replay them.
+# Each request becomes <directory>/<session>/<ms since session start>-<endpoint>.<ext>,
+# written off the request thread.
+class SessionRecorder:
+    def __init__(self, directory, queue_size=256):
+        self.sink = DebugArtifactSink(directory=directory, mode="every", every=1, queue_size=queue_size)
+        self.started_at = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, session_id, endpoint, data):
+        session_id = re.sub(r'[^A-Za-z0-9_-]', '', session_id or '')[:64] or 'anonymous'
+        now = time.monotonic()
+        with self.lock:
+            started_at = self.started_at.setdefault(session_id, now)
+            self.started_at.move_to_end(session_id)
+            while len(self.started_at) > MAX_SESSIONS:
+                self.started_at.popitem(last=False)
+
+        offset_ms = int((now - started_at) * 1000)
+        artifacts = self.sink.begin()
+        artifacts.add(f"{session_id}/{offset_ms:09d}-{endpoint}.{image_extension(data)}", bytes(data))
+        self.sink.submit(artifacts)
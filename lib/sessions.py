@@ -0,0 +1,52 @@
+import time
+import threading
+from collections import OrderedDict
+
+from lib.frame_gate import FrameGate, FrameGateStats
+from lib.tracker import Tracker
+
+
+# Per-client state for the live camera loop
+class Session:
+    def __init__(self, id, gate, tracker):
+        self.id = id
+        self.gate = gate
+        self.tracker = tracker
+        self.last_seen = time.monotonic()
+
+
+# Bounded set of live sessions, least recently seen are dropped first
+class SessionStore:
+    def __init__(self, max_sessions=256, ttl=600, gate_threshold=3.0, gate_size=32):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.gate_threshold = gate_threshold
+        self.gate_size = gate_size
+        self.gate_stats = FrameGateStats()
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, id):
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(id)
+            if session is None:
+                session = self.sessions[id] = self.new_session(id)
+            session.last_seen = now
+            self.sessions.move_to_end(id)
+            self.expire(now)
+            return session
+
+    def new_session(self, id):
+        gate = FrameGate(threshold=self.gate_threshold, size=self.gate_size, stats=self.gate_stats)
+        return Session(id, gate, Tracker())
+
+    def expire(self, now):
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if len(self.sessions) <= self.max_sessions and now - session.last_seen < self.ttl:
+                break
+            self.sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self.sessions)
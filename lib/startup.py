@@ -0,0 +1,109 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+DEFAULT_INPUT_SIZE = 640
+
+logger = logging.getLogger(__name__)
+
+
+# Input resolution a YOLO checkpoint was trained at
+def model_input_size(model):
+    imgsz = getattr(model, 'overrides', {}).get('imgsz')
+    if imgsz is not None:
+        return int(max(imgsz) if isinstance(imgsz, (list, tuple)) else imgsz)
+    try:
+        imgsz = model.model.args['imgsz']
+    except (AttributeError, KeyError, TypeError):
+        return DEFAULT_INPUT_SIZE
+    if isinstance(imgsz, (list, tuple)):
+        imgsz = max(imgsz)
+    return int(imgsz)
+
+
+# Loads models in the background so the server can bind right away, and
+# records how long each phase took. Models load in parallel, then each gets
+# one warm-up inference so the first real request doesn't pay for lazy
+# initialization.
+class Startup:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.phases = OrderedDict()
+        self.ready = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = time.monotonic() - start
+
+    def timed(self, name, fn, *args):
+        with self.phase(name):
+            return fn(*args)
+
+    # specs is {name: (checkpoint, task)}, returns {name: model}. load is
+    # called as load(checkpoint, task) and defaults to ultralytics' YOLO.
+    def load_models(self, specs, load=None):
+        with self.phase('import ultralytics'):
+            from ultralytics import YOLO
+        if load is None:
+            load = YOLO
+
+        with ThreadPoolExecutor(max_workers=len(specs), thread_name_prefix='load') as pool:
+            futures = {name: pool.submit(self.timed, f'load {name}', load, *spec)
+                       for name, spec in specs.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def warm_up(self, models):
+        with ThreadPoolExecutor(max_workers=len(models), thread_name_prefix='warm-up') as pool:
+            futures = [pool.submit(self.timed, f'warm-up {name}', warm_up_model, model)
+                       for name, model in models.items()]
+            for future in futures:
+                future.result()
+
+    # Runs fn in a background thread, ready is set once it finishes
+    def start(self, fn):
+        thread = threading.Thread(target=self.run, args=(fn,), name='startup', daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, fn):
+        try:
+            fn()
+            self.finished_at = time.monotonic()
+            self.ready.set()
+        except Exception as e:
+            self.error = e
+            logger.exception("Startup failed")
+        logger.info("Startup: %s", self.report())
+
+    @property
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def report(self):
+        end = self.finished_at or time.monotonic()
+        with self.lock:
+            phases = {name: round(seconds * 1000) for name, seconds in self.phases.items()}
+        return {
+            'ready': self.is_ready,
+            'error': str(self.error) if self.error else None,
+            'total_ms': round((end - self.started_at) * 1000),
+            'phases_ms': phases,
+        }
+
+
+def warm_up_model(model):
+    size = model_input_size(model)
+    model.predict(source=Image.new("RGB", (size, size), "white"), verbose=False)
@@ -0,0 +1,174 @@
+import time
+
+import numpy as np
+
+from lib.lego_colors import lego_colors
+
+# Deterministic stand-ins for the YOLO models and bricks.db, so the
+# benchmarks and load tests run anywhere without weights. They mimic just
+# enough of ultralytics' Results API for Predictor and serve.py.
+
+
+# Boxes on a regular grid covering the middle of the frame, the same layout
+# the benchmark draws its synthetic pieces in
+def grid_boxes(width, height, count):
+    if count == 0:
+        return np.zeros((0, 4), dtype=np.float32)
+    columns = int(np.ceil(np.sqrt(count * width / height)))
+    rows = int(np.ceil(count / columns))
+    cell_w = width * 0.9 / columns
+    cell_h = height * 0.9 / rows
+    boxes = []
+    for i in range(count):
+        row, column = divmod(i, columns)
+        x1 = width * 0.05 + column * cell_w + cell_w * 0.2
+        y1 = height * 0.05 + row * cell_h + cell_h * 0.2
+        # vary the sizes a little so area sorting has something to do
+        scale = 0.5 + 0.1 * (i % 4)
+        boxes.append([x1, y1, x1 + cell_w * scale, y1 + cell_h * scale])
+    return np.asarray(boxes, dtype=np.float32)
+
+
+def image_size(source):
+    if hasattr(source, 'size') and not isinstance(source, np.ndarray):
+        return source.size
+    return source.shape[1], source.shape[0]
+
+
+class StubBox:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = xyxy[None, :]
+        self.conf = np.asarray([conf])
+        self.cls = np.asarray([cls])
+
+
+class StubBoxes:
+    def __init__(self, xyxy):
+        self.xyxy = xyxy
+        self.conf = np.linspace(0.95, 0.5, len(xyxy), dtype=np.float32) if len(xyxy) else np.zeros(0, dtype=np.float32)
+        self.cls = np.zeros(len(xyxy), dtype=np.float32)
+        self.data = np.concatenate([xyxy, self.conf[:, None], self.cls[:, None]], axis=1)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self
+
+    def __len__(self):
+        return len(self.xyxy)
+
+    def __iter__(self):
+        for xyxy, conf, cls in zip(self.xyxy, self.conf, self.cls):
+            yield StubBox(xyxy, conf, cls)
+
+
+class StubProbs:
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def top1(self):
+        return int(self.data.argmax())
+
+    @property
+    def top5(self):
+        return [int(i) for i in np.argsort(-self.data)[:5]]
+
+
+class StubResult:
+    def __init__(self, names, orig_shape, boxes=None, probs=None):
+        self.names = names
+        self.orig_shape = orig_shape
+        self.boxes = boxes
+        self.probs = probs
+
+    def cpu(self):
+        return self
+
+    def plot(self):
+        return np.full((self.orig_shape[0], self.orig_shape[1], 3), 255, dtype=np.uint8)
+
+
+class StubModel:
+    def __init__(self, task, names, imgsz, latency_ms=0.0, per_image_ms=0.0):
+        self.task = task
+        self.names = names
+        self.overrides = {'imgsz': imgsz}
+        self.latency_ms = latency_ms
+        self.per_image_ms = per_image_ms
+
+    def __call__(self, source=None, **kwargs):
+        return self.predict(source=source, **kwargs)
+
+    def predict(self, source=None, **kwargs):
+        sources = source if isinstance(source, list) else [source]
+        # pretend to be a forward pass: fixed overhead plus a cost per image
+        delay = self.latency_ms + self.per_image_ms * len(sources)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        return [self.result(item) for item in sources]
+
+
+class StubDetectionModel(StubModel):
+    def __init__(self, pieces=15, **kwargs):
+        super().__init__('detect', {0: 'lego'}, 640, **kwargs)
+        self.pieces = pieces
+
+    def result(self, source):
+        width, height = image_size(source)
+        return StubResult(self.names, (height, width), boxes=StubBoxes(grid_boxes(width, height, self.pieces)))
+
+
+class StubClassificationModel(StubModel):
+    def __init__(self, names, **kwargs):
+        super().__init__('classify', names, 224, **kwargs)
+
+    # Peaked on a class derived from the crop's size, so the same crop always
+    # gets the same answer
+    def result(self, source):
+        width, height = image_size(source)
+        count = len(self.names)
+        data = np.full(count, 0.1 / max(1, count - 1), dtype=np.float32)
+        data[(width * 31 + height) % count] = 0.9
+        return StubResult(self.names, (height, width), probs=StubProbs(data))
+
+
+def stub_part_names():
+    return {0: '3001', 1: '3003', 2: '3004', 3: '3010', 4: '3020', 5: '3022', 6: '3023', 7: '3024'}
+
+
+def stub_color_names():
+    return {i: str(color.id) for i, color in enumerate(lego_colors[:40])}
+
+
+# Stand-in for lib.db.Db with no parts, every class resolves to
+# '??? mismatched ids'
+class StubDb:
+    path = ':stub:'
+
+    def get_part_by_num(self, num):
+        return None
+
+    def get_parts_by_nums(self, nums):
+        return {}
+
+    def get_ldraw_id_for_part_num(self, num):
+        return None
+
+    def get_ldraw_ids_for_part_nums(self, nums):
+        return {}
+
+    def reload(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def stub_models(pieces=15, latency_ms=0.0, per_image_ms=0.0):
+    return (
+        StubDetectionModel(pieces=pieces, latency_ms=latency_ms, per_image_ms=per_image_ms),
+        StubClassificationModel(stub_part_names(), latency_ms=latency_ms, per_image_ms=per_image_ms),
+        StubClassificationModel(stub_color_names(), latency_ms=latency_ms, per_image_ms=per_image_ms),
+    )
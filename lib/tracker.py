@@ -0,0 +1,145 @@
+import math
+import time
+import threading
+
+import numpy as np
+from PIL import Image
+
+from lib.box_collection import BoxCollection
+
+# Boxes overlapping a track at least this much are the same piece
+MATCH_IOU = 0.3
+# Otherwise the nearest track whose center is within this fraction of the
+# box's size is
+MATCH_CENTER_DISTANCE = 0.5
+# A piece is classified again once its box drifted below this overlap with
+# the box it was classified at
+RECLASSIFY_IOU = 0.6
+# Tracks not seen for this many frames are forgotten
+MAX_MISSED = 15
+# A result is only reused while the piece was seen in frames at most this
+# many seconds apart, and for at most RESULT_MAX_AGE seconds overall
+MAX_FRAME_GAP = 1.0
+RESULT_MAX_AGE = 30.0
+# Pieces are compared as tiny grayscale thumbnails of their box, a mean
+# absolute difference (0-255) above the threshold means a different piece
+SIGNATURE_SIZE = 16
+SIGNATURE_THRESHOLD = 12.0
+
+
+class Track:
+    def __init__(self, id, xyxy):
+        self.id = id
+        self.xyxy = xyxy
+        self.missed = 0
+        self.seen_at = time.monotonic()
+        # what /classify answered for this piece, where the box was then,
+        # what the piece looked like and when
+        self.result = None
+        self.result_xyxy = None
+        self.result_signature = None
+        self.result_at = None
+
+
+# Follows pieces across one session's frames so each keeps a stable id and
+# its classification can be reused. Boxes are tracked in frame-relative
+# coordinates (0-1), so small live frames and full resolution shots of the
+# same view line up. Association is greedy on IoU with a center-distance
+# fallback for small, fast-moving boxes.
+class Tracker:
+    def __init__(self):
+        self.tracks = []
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    # Returns one Track per box, in the same order
+    def update(self, boxes, frame_size):
+        width, height = frame_size
+        boxes = BoxCollection(boxes.xyxy / np.asarray([width, height, width, height], dtype=np.float64))
+        now = time.monotonic()
+        with self.lock:
+            matches = self.associate(boxes)
+            tracks = []
+            for i, xyxy in enumerate(boxes.xyxy):
+                track = matches.get(i)
+                if track is None:
+                    track = Track(self.next_id, xyxy)
+                    self.next_id += 1
+                    self.tracks.append(track)
+                elif now - track.seen_at > MAX_FRAME_GAP:
+                    # nobody watched the piece in between, it may have been swapped
+                    track.result = None
+                track.xyxy = xyxy
+                track.missed = 0
+                track.seen_at = now
+                tracks.append(track)
+
+            matched = {id(track) for track in tracks}
+            for track in self.tracks:
+                if id(track) not in matched:
+                    track.missed += 1
+            self.tracks = [track for track in self.tracks if track.missed <= MAX_MISSED]
+            return tracks
+
+    def associate(self, boxes):
+        if not self.tracks or len(boxes) == 0:
+            return {}
+        known = BoxCollection([track.xyxy for track in self.tracks])
+        overlaps = boxes.iou(known)
+        sizes = np.maximum(boxes.widths, boxes.heights)
+        distances = np.linalg.norm(boxes.centers[:, None, :] - known.centers[None, :, :], axis=-1)
+        close = distances < MATCH_CENTER_DISTANCE * sizes[:, None]
+        # IoU matches rank above center matches, nearer centers break ties
+        scores = np.where(overlaps >= MATCH_IOU, 1 + overlaps, np.where(close, 1 - distances, -np.inf))
+
+        matches = {}
+        used = set()
+        for flat in np.argsort(-scores, axis=None, kind='stable'):
+            box, track = (int(i) for i in np.unravel_index(flat, scores.shape))
+            if not np.isfinite(scores[box, track]):
+                break
+            if box in matches or track in used:
+                continue
+            matches[box] = self.tracks[track]
+            used.add(track)
+        return matches
+
+    # The cached /classify result for a track, None when it has none, it's
+    # too old, the piece moved too much since or, given the piece's current
+    # signature, looks different
+    def result(self, track, signature=None):
+        with self.lock:
+            if track.result is None or time.monotonic() - track.result_at > RESULT_MAX_AGE:
+                return None
+            overlap = BoxCollection([track.xyxy]).iou(BoxCollection([track.result_xyxy]))[0, 0]
+            if overlap < RECLASSIFY_IOU:
+                return None
+            if signature is not None and track.result_signature is not None:
+                if float(np.abs(signature - track.result_signature).mean()) > SIGNATURE_THRESHOLD:
+                    return None
+            return track.result
+
+    def remember(self, track, result, signature=None):
+        with self.lock:
+            track.result = result
+            track.result_xyxy = track.xyxy
+            track.result_signature = signature
+            track.result_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.tracks)
+
+
+# What each box of a BoxCollection (in frame_size pixels) looks like in
+# image, a downscaled copy of the same frame, for Tracker.result
+def signatures(image, boxes, frame_size):
+    scale_x, scale_y = image.width / frame_size[0], image.height / frame_size[1]
+    gray = image.convert("L")
+    result = []
+    for x1, y1, x2, y2 in boxes.xyxy.tolist():
+        # at least a pixel, so tiny boxes still get a thumbnail
+        left, top = int(x1 * scale_x), int(y1 * scale_y)
+        right, bottom = max(left + 1, math.ceil(x2 * scale_x)), max(top + 1, math.ceil(y2 * scale_y))
+        thumbnail = gray.crop((left, top, right, bottom)).resize((SIGNATURE_SIZE, SIGNATURE_SIZE), Image.BILINEAR)
+        result.append(np.asarray(thumbnail, dtype=np.int16))
+    return result
@@ -0,0 +1,277 @@
+# Load test for serve.py: replays recorded camera sessions from many virtual
+# phones at once and reports throughput, tail latency and error rate per endpoint.
+#
+#   STUB_MODELS=1 python serve.py                              # no weights needed
+#   RECORD_SESSIONS_DIR=tmp/sessions python serve.py           # record real sessions
+#   python load-test.py --sessions tmp/sessions --concurrency 20 --duration 60
+#   python load-test.py --frames tmp --fps 10 --classify-every 50
+#
+# Recorded sessions are directories of <ms since start>-<endpoint>.<ext> files.
+# Without recordings, --frames builds a synthetic detectionLoop session from the
+# images saved under tmp/: one /detect per frame and a /classify every N frames.
+#
+# Every upload is made unique with a JPEG comment or PNG text chunk, so the
+# server's content-keyed result cache can't answer it and the numbers measure
+# inference. --same-bytes sends the files as they are, to measure the cache.
+import os
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import struct
+import argparse
+import threading
+import urllib.error
+import urllib.request
+
+RECORDING_PATTERN = re.compile(r'^(\d+)-([a-z_]+)\.(jpg|png|webp|bin)$')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'bin': 'application/octet-stream',
+}
+ENDPOINTS = {
+    'detect': '/detect',
+    'classify': '/classify',
+    'capture': '/capture',
+}
+
+
+# One upload at offset_ms into a session
+class Event:
+    def __init__(self, offset_ms, endpoint, path):
+        self.offset_ms = offset_ms
+        self.endpoint = endpoint
+        self.path = path
+        self.content_type = CONTENT_TYPES[path.rsplit('.', 1)[-1].lower()]
+        self.data = None
+
+    def body(self):
+        if self.data is None:
+            with open(self.path, 'rb') as f:
+                self.data = f.read()
+        return self.data
+
+
+# The same image with a marker the decoders ignore but that changes its
+# bytes. Formats without a safe place for one are sent unchanged.
+def unique_body(data, marker):
+    marker = marker.encode()
+    if data[:2] == b'\xff\xd8':
+        # COM segment after the JFIF/EXIF (APPn) segments, so the EXIF
+        # orientation is still where readers expect it
+        i = 2
+        while data[i:i + 1] == b'\xff' and 0xe0 <= data[i + 1] <= 0xef:
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+        return data[:i] + b'\xff\xfe' + struct.pack('>H', len(marker) + 2) + marker + data[i:]
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        # tEXt chunk right after IHDR, which is always 25 bytes
+        chunk = b'tEXt' + b'load-test\x00' + marker
+        text = struct.pack('>I', len(chunk) - 4) + chunk + struct.pack('>I', zlib.crc32(chunk))
+        return data[:33] + text + data[33:]
+    return data
+
+
+def recorded_sessions(directory):
+    sessions = []
+    for name in sorted(os.listdir(directory)):
+        session_dir = os.path.join(directory, name)
+        if not os.path.isdir(session_dir):
+            continue
+        events = []
+        for filename in sorted(os.listdir(session_dir)):
+            match = RECORDING_PATTERN.match(filename)
+            if match and match.group(2) in ENDPOINTS:
+                events.append(Event(int(match.group(1)), match.group(2), os.path.join(session_dir, filename)))
+        if events:
+            sessions.append(events)
+    return sessions
+
+
+def synthetic_sessions(directory, fps, classify_every):
+    frames = sorted(
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if filename.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    events = []
+    for i, path in enumerate(frames):
+        offset_ms = int(i * 1000 / fps)
+        events.append(Event(offset_ms, 'detect', path))
+        if classify_every and (i + 1) % classify_every == 0:
+            events.append(Event(offset_ms, 'classify', path))
+    return [events] if events else []
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def add(self, endpoint, seconds, status, ok):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + (0 if ok else 1)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def report(self, elapsed):
+        report = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            report[endpoint] = {
+                'requests': len(latencies),
+                'throughput_rps': len(latencies) / elapsed,
+                'error_rate': self.errors[endpoint] / len(latencies),
+                'statuses': {str(status): count for status, count in sorted(self.statuses[endpoint].items(), key=str)},
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+            }
+        return report
+
+
+def send(url, event, session_id, timeout, marker=None):
+    body = event.body()
+    if marker is not None:
+        body = unique_body(body, marker)
+    request = urllib.request.Request(
+        url + ENDPOINTS[event.endpoint],
+        data=body,
+        headers={'Content-Type': event.content_type, 'X-Session-Id': session_id},
+        method='POST',
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, False
+    except (urllib.error.URLError, OSError) as e:
+        return type(e).__name__, False
+
+    try:
+        ok = json.loads(body).get('success', True) is not False
+    except ValueError:
+        ok = False
+    return status, ok
+
+
+# A virtual phone: replays a session at its recorded pace (scaled by --rate),
+# never with more than one request in flight, looping until the deadline.
+def run_client(client, sessions, args, deadline, results):
+    jitter = random.Random(client)
+    session = sessions[client % len(sessions)]
+    loop = 0
+    sent = 0
+    while time.monotonic() < deadline:
+        session_id = f"load-{client}-{loop}"
+        started = time.monotonic() + jitter.uniform(0, 0.1)
+        for event in session:
+            wait = started + event.offset_ms / 1000 / args.rate - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if time.monotonic() >= deadline:
+                return
+            marker = None if args.same_bytes else f"{client}-{sent}"
+            sent += 1
+            request_start = time.perf_counter()
+            status, ok = send(args.url, event, session_id, args.timeout, marker)
+            results.add(event.endpoint, time.perf_counter() - request_start, status, ok)
+        loop += 1
+
+
+def wait_until_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(1)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay camera sessions against serve.py')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--sessions', help='directory of sessions recorded with RECORD_SESSIONS_DIR')
+    parser.add_argument('--frames', default='tmp', help='images for a synthetic session when --sessions is not given')
+    parser.add_argument('--fps', type=float, default=10, help='frame rate of the synthetic session')
+    parser.add_argument('--classify-every', type=int, default=50, help='synthetic /classify after every N frames, 0 for none')
+    parser.add_argument('--concurrency', type=int, default=10, help='number of virtual phones')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--rate', type=float, default=1.0, help='replay speed, 2 = twice as fast as recorded')
+    parser.add_argument('--timeout', type=float, default=30, help='per request timeout in seconds')
+    parser.add_argument('--ready-timeout', type=float, default=120, help='seconds to wait for /readyz')
+    parser.add_argument('--same-bytes', action='store_true',
+                        help="send every file as is, so repeats can be answered from the server's result cache")
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    args.url = args.url.rstrip('/')
+    if args.sessions:
+        sessions = recorded_sessions(args.sessions)
+    else:
+        sessions = synthetic_sessions(args.frames, args.fps, args.classify_every)
+    if not sessions:
+        sys.exit(f"No frames found in {args.sessions or args.frames}")
+
+    if not wait_until_ready(args.url, args.ready_timeout):
+        sys.exit(f"{args.url} did not become ready within {args.ready_timeout:.0f}s")
+
+    events = sum(len(session) for session in sessions)
+    payloads = 'same bytes, result cache hits allowed' if args.same_bytes else 'unique bytes per request, no result cache hits'
+    print(f"Replaying {len(sessions)} session(s), {events} uploads, with {args.concurrency} clients for {args.duration:.0f}s ({payloads})")
+
+    results = Results()
+    start = time.monotonic()
+    deadline = start + args.duration
+    clients = [
+        threading.Thread(target=run_client, args=(client, sessions, args, deadline, results), daemon=True)
+        for client in range(args.concurrency)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.monotonic() - start
+
+    report = results.report(elapsed)
+    print(f"{'endpoint':<10}{'requests':>9}{'req/s':>9}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for endpoint, row in report.items():
+        print(
+            f"{endpoint:<10}{row['requests']:>9}{row['throughput_rps']:>9.1f}{row['error_rate']:>7.1%} "
+            f"{row['p50_ms']:>7.0f}ms{row['p95_ms']:>7.0f}ms{row['p99_ms']:>7.0f}ms{row['max_ms']:>7.0f}ms"
+        )
+        if row['error_rate']:
+            print(f"{'':<10}statuses {row['statuses']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'elapsed_s': elapsed, 'concurrency': args.concurrency, 'rate': args.rate,
+                       'same_bytes': args.same_bytes, 'endpoints': report}, f, indent=2)
+        print(f"Saved report to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
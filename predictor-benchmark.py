@@ -0,0 +1,224 @@
+# Offline benchmark for the /classify path: decode, orientation, detection,
+# cropping, classification, color and response encoding, on synthetic
+# phone-sized tray photos with 1, 15 and 100 pieces.
+#
+#   python predictor-benchmark.py                    # deterministic stub models
+#   python predictor-benchmark.py --real             # real checkpoints from lib/config.py
+#   python predictor-benchmark.py --save-baseline    # record the current numbers
+#
+# Exits with an error when a stage's p50 regresses past --threshold, or a
+# case's peak RSS growth past --memory-threshold, compared to the baseline
+# in benchmarks/.
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from lib import config
+from lib.crop_store import CropStore
+from lib.debug_artifacts import DebugArtifacts
+from lib.lego_colors import lego_colors
+from lib.metrics import record_spans, span
+from lib.predictor import Predictor
+from lib.service import ingest, classify_objects
+from lib.stub_models import grid_boxes, stub_models, StubDb
+
+PIECE_COUNTS = (1, 15, 100)
+# display size and EXIF orientation, portrait shots are stored sideways
+RESOLUTIONS = (
+    ('12mp-landscape', (4032, 3024), 1),
+    ('12mp-portrait', (3024, 4032), 6),
+)
+ORIENTATION_TAG = 0x0112
+# How often the process RSS is sampled while a case runs
+RSS_SAMPLE_SECONDS = 0.005
+
+
+def synthetic_photo(width, height, pieces, orientation):
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for i, box in enumerate(grid_boxes(width, height, pieces)):
+        color = lego_colors[i % 40]
+        draw.rectangle(tuple(float(v) for v in box), fill=tuple(color.rgb()))
+
+    exif = Image.Exif()
+    if orientation == 6:
+        # orientation 6 is displayed after rotating 90 degrees clockwise
+        image = image.transpose(Image.ROTATE_90)
+        exif[ORIENTATION_TAG] = 6
+
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=90, exif=exif)
+    return buffer.getvalue()
+
+
+def build_predictor(args):
+    if args.real:
+        from lib.backends import load_model
+        from lib.db import Db
+        missing = [p for p in (config.DETECTION_MODEL, config.CLASSIFICATION_MODEL, config.COLOR_MODEL) if not os.path.exists(p)]
+        if missing:
+            sys.exit(f"--real needs the model checkpoints, missing: {', '.join(missing)}")
+        models = (
+            load_model(config.DETECTION_MODEL, 'detect', backend=config.INFERENCE_BACKEND, int8=config.INFERENCE_INT8),
+            load_model(config.CLASSIFICATION_MODEL, 'classify', backend=config.INFERENCE_BACKEND, int8=config.INFERENCE_INT8),
+            load_model(config.COLOR_MODEL, 'classify', backend=config.INFERENCE_BACKEND, int8=config.INFERENCE_INT8),
+        )
+        return Predictor(*models, Db(), color_mode=args.color_mode)
+
+    models = stub_models(latency_ms=args.stub_latency_ms, per_image_ms=args.stub_per_image_ms)
+    return Predictor(*models, StubDb(), color_mode=args.color_mode)
+
+
+def run_once(predictor, data):
+    artifacts = DebugArtifacts(enabled=False)
+    crop_store = CropStore(format=config.CROP_FORMAT, quality=config.CROP_QUALITY, max_size=config.CROP_MAX_SIZE)
+    with record_spans() as spans:
+        start = time.perf_counter()
+        response = classify_objects(ingest(data, config.MAX_INPUT_PIXELS), predictor, crop_store, artifacts)
+        with span('encode'):
+            json.dumps(response)
+        spans['total'] = time.perf_counter() - start
+    return spans
+
+
+# Resident set size in bytes. Unlike tracemalloc this includes PIL decode
+# buffers, numpy/torch tensors and ONNX arenas.
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # no /proc (macOS): the process peak so far, reported in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Samples the RSS on a background thread, peak is the highest seen
+class RssSampler:
+    def __init__(self):
+        self.start_rss = current_rss()
+        self.peak = self.start_rss
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def run_case(predictor, data, repeats):
+    run_once(predictor, data)  # warm up
+
+    with RssSampler() as rss:
+        runs = [run_once(predictor, data) for _ in range(repeats)]
+
+    stages = sorted({stage for run in runs for stage in run})
+    return {
+        'stages': {
+            stage: {
+                'p50_ms': float(np.percentile([run.get(stage, 0.0) for run in runs], 50)) * 1000,
+                'p95_ms': float(np.percentile([run.get(stage, 0.0) for run in runs], 95)) * 1000,
+            }
+            for stage in stages
+        },
+        # what the case needed on top of what the process already held
+        'peak_rss_growth_mb': (rss.peak - rss.start_rss) / 1024 / 1024,
+        'peak_rss_mb': rss.peak / 1024 / 1024,
+    }
+
+
+def regressions(results, baseline, threshold, min_ms, memory_threshold, min_mb):
+    found = []
+    for case, result in results.items():
+        expected_mb = baseline.get(case, {}).get('peak_rss_growth_mb')
+        if expected_mb is not None:
+            allowed = max(expected_mb * (1 + memory_threshold), expected_mb + min_mb)
+            if result['peak_rss_growth_mb'] > allowed:
+                found.append(f"{case}: peak RSS growth {result['peak_rss_growth_mb']:.1f}MB > "
+                             f"{expected_mb:.1f}MB baseline")
+        for stage, timing in result['stages'].items():
+            expected = baseline.get(case, {}).get('stages', {}).get(stage)
+            if expected is None:
+                continue
+            allowed = max(expected['p50_ms'] * (1 + threshold), expected['p50_ms'] + min_ms)
+            if timing['p50_ms'] > allowed:
+                found.append(f"{case} {stage}: p50 {timing['p50_ms']:.1f}ms > {expected['p50_ms']:.1f}ms baseline")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the classify path')
+    parser.add_argument('--real', action='store_true', help='use the real checkpoints instead of stub models')
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--baseline', help='baseline file (default benchmarks/baseline-{stub,real}.json)')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed p50 slowdown, 0.25 = 25%%')
+    parser.add_argument('--min-ms', type=float, default=2.0, help='ignore regressions smaller than this')
+    parser.add_argument('--memory-threshold', type=float, default=0.25,
+                        help='allowed peak RSS growth increase, 0.25 = 25%%')
+    parser.add_argument('--min-mb', type=float, default=16.0, help='ignore memory regressions smaller than this')
+    parser.add_argument('--color-mode', default='model', help='model, palette or check, see lib/predictor.py')
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0, help='simulated cost per stub forward pass')
+    parser.add_argument('--stub-per-image-ms', type=float, default=0.0, help='simulated cost per image in a stub batch')
+    args = parser.parse_args()
+
+    baseline_path = args.baseline or os.path.join('benchmarks', f"baseline-{'real' if args.real else 'stub'}.json")
+    predictor = build_predictor(args)
+
+    results = {}
+    for resolution_name, (width, height), orientation in RESOLUTIONS:
+        for pieces in PIECE_COUNTS:
+            case = f"{resolution_name}-{pieces}"
+            if not args.real:
+                predictor.detection_model.pieces = pieces
+            data = synthetic_photo(width, height, pieces, orientation)
+            results[case] = run_case(predictor, data, args.repeats)
+
+            print(f"{case}  (peak RSS {results[case]['peak_rss_mb']:.0f} MB, "
+                  f"+{results[case]['peak_rss_growth_mb']:.1f} MB during the case)")
+            for stage, timing in results[case]['stages'].items():
+                print(f"  {stage:<18}p50 {timing['p50_ms']:>8.1f}ms   p95 {timing['p95_ms']:>8.1f}ms")
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"peak RSS {peak_rss_mb:.0f} MB")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {baseline_path}")
+        return
+
+    if not os.path.exists(baseline_path):
+        print(f"No baseline at {baseline_path}, run with --save-baseline to create one")
+        return
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    found = regressions(results, baseline, args.threshold, args.min_ms, args.memory_threshold, args.min_mb)
+    if found:
+        print("Regressions:")
+        for line in found:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"No regressions against {baseline_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,221 +1,676 @@
 import os
+import time
 import uuid
-from ultralytics import YOLO
-from PIL import Image, ImageDraw
-from flask import Flask, request, jsonify, g
+import logging
+from functools import wraps
+from PIL import ImageDraw
+from flask import Flask, request, jsonify, g, make_response, abort, Response, stream_with_context
 from flask_cors import CORS
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
 import base64
-import torch
-from io import BytesIO
-import cv2
-from cv2 import aruco
-import numpy as np
-import traceback
 import re
 import hashlib
+import json
+import queue
+import threading
 
-from PIL import Image
 from lib.lego_colors import lego_colors_by_id
-from lib.bounding_box import BoundingBox
 from lib.json_utils import decimal_default
-from lib.image_utils import image_to_data_url, correct_image_orientation, compute_image_hash
+from lib.image_utils import compute_image_hash
 from lib.db import Db
 from lib.compensate import canonical_part_id
 from lib.predictor import Predictor
 from lib.aruco_utils import aruco_ids_to_color_id, draw_aruco_corners
 from lib.aruco_marker_set import ArucoMarkerSet
-
-detection_model = YOLO("lego-detect-13-7k-more-negatives3.pt")
-classification_model = YOLO("03-447x.pt")
-color_model = YOLO("lego-color-10-more-photos-nano.pt")
-
-aruco_detector = aruco.ArucoDetector(aruco.getPredefinedDictionary(aruco.DICT_6X6_100))
+from lib.frame import Frame
+from lib.debug_artifacts import DebugArtifactSink
+from lib.crop_store import CropStore
+from lib.result_cache import ResultCache, cache_key, file_fingerprint
+from lib.sessions import SessionStore
+from lib.latest_value import LatestValue
+from lib.inference_scheduler import BatchingModel
+from lib.startup import Startup, model_input_size
+from lib.backends import load_model
+from lib.metrics import registry, span, request_seconds, boxes_per_image
+from lib.service import open_image, orient, ingest, detect_boxes, track_boxes, classify_objects, classify_events, crop_key
+from lib.service import ClassifyJob, classify_pipeline
+from lib.session_recorder import SessionRecorder
+from lib.stub_models import stub_models, StubDb
+from lib.prefork import set_inference_threads
+from lib.admission import AdmissionController, EndpointLimits, Overloaded
+from lib import config
+
+logging.basicConfig(level=config.LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+DETECTION_MODEL = config.DETECTION_MODEL
+CLASSIFICATION_MODEL = config.CLASSIFICATION_MODEL
+COLOR_MODEL = config.COLOR_MODEL
+
+# Set once the models have loaded, see load_models()
+detection_model = None
+classification_model = None
+color_model = None
+predictor = None
+classification_pipeline = None
 
 
 app = Flask(__name__, static_url_path='/')
 
 app.static_folder = 'static'
 
-db = Db(g)
+sock = Sock(app)
+
+db = Db()
+
+debug_artifacts = DebugArtifactSink(
+    directory=config.DEBUG_ARTIFACTS_DIR,
+    mode=config.DEBUG_ARTIFACTS_MODE,
+    every=config.DEBUG_ARTIFACTS_EVERY,
+    queue_size=config.DEBUG_ARTIFACTS_QUEUE_SIZE,
+)
+
+crop_store = CropStore(
+    max_bytes=config.CROP_STORE_MAX_BYTES,
+    format=config.CROP_FORMAT,
+    quality=config.CROP_QUALITY,
+    max_size=config.CROP_MAX_SIZE,
+    directory=config.CROP_STORE_DIR or None,
+)
+
+result_cache = ResultCache(
+    max_entries=config.RESULT_CACHE_SIZE,
+    directory=config.RESULT_CACHE_DIR or None,
+)
+
+sessions = SessionStore(
+    max_sessions=config.MAX_SESSIONS,
+    ttl=config.SESSION_TTL,
+    gate_threshold=config.DETECT_GATE_THRESHOLD,
+    gate_size=config.DETECT_GATE_SIZE,
+)
+
+# User-initiated shots go ahead of live detection frames
+admission = AdmissionController(
+    slots=config.ADMISSION_SLOTS,
+    limits={
+        'classify': EndpointLimits(config.CLASSIFY_CONCURRENCY, config.CLASSIFY_QUEUE, priority=0),
+        'capture': EndpointLimits(config.CLASSIFY_CONCURRENCY, config.CLASSIFY_QUEUE, priority=0),
+        'detect': EndpointLimits(config.DETECT_CONCURRENCY, config.DETECT_QUEUE, priority=1),
+    },
+    max_wait=config.ADMISSION_MAX_WAIT,
+)
+
+# Cached results are invalidated whenever a checkpoint or backend changes
+model_version = cache_key(
+    file_fingerprint([DETECTION_MODEL, CLASSIFICATION_MODEL, COLOR_MODEL]),
+    config.INFERENCE_BACKEND,
+    str(config.INFERENCE_INT8),
+    'stub' if config.STUB_MODELS else 'real',
+)
+
+session_recorder = SessionRecorder(config.RECORD_SESSIONS_DIR) if config.RECORD_SESSIONS_DIR else None
+
+startup = Startup()
+
+def load_models():
+    global detection_model, classification_model, color_model, predictor, classification_pipeline
+
+    if config.STUB_MODELS:
+        # For load tests without weights, see lib/stub_models.py
+        with startup.phase('load stubs'):
+            detect, classify, color = stub_models(
+                pieces=config.STUB_PIECES,
+                latency_ms=config.STUB_LATENCY_MS,
+                per_image_ms=config.STUB_PER_IMAGE_MS)
+        predictor_db = StubDb()
+    else:
+        models = startup.load_models({
+            'detect': (DETECTION_MODEL, 'detect'),
+            'classify': (CLASSIFICATION_MODEL, 'classify'),
+            'color': (COLOR_MODEL, 'classify'),
+        }, load=load_configured_model)
+        startup.warm_up(models)
+        detect, classify, color = models['detect'], models['classify'], models['color']
+        predictor_db = db
+
+    if config.INFERENCE_BATCHING:
+        detect = BatchingModel(detect, 'detect', config.DETECT_BATCH_SIZE, config.BATCH_MAX_WAIT_MS)
+        classify = BatchingModel(classify, 'classify', config.CLASSIFY_BATCH_SIZE, config.BATCH_MAX_WAIT_MS)
+        color = BatchingModel(color, 'color', config.CLASSIFY_BATCH_SIZE, config.BATCH_MAX_WAIT_MS)
+
+    with startup.phase('class table'):
+        new_predictor = Predictor(detect, classify, color, predictor_db, color_mode=config.COLOR_MODE,
+                                  model_version=model_version)
+        new_predictor.reload_classes()
+
+    new_pipeline = None
+    if config.CLASSIFY_PIPELINE:
+        new_pipeline = classify_pipeline(new_predictor, crop_store, {
+            'decode': config.PIPELINE_DECODE_WORKERS,
+            'detect': config.PIPELINE_DETECT_WORKERS,
+            'crop': config.PIPELINE_CROP_WORKERS,
+            'classify': config.PIPELINE_CLASSIFY_WORKERS,
+            'encode': config.PIPELINE_ENCODE_WORKERS,
+        }, config.PIPELINE_QUEUE_SIZE, config.PIPELINE_TIMEOUT)
+
+    detection_model, classification_model, color_model = detect, classify, color
+    predictor = new_predictor
+    classification_pipeline = new_pipeline
+
+def load_configured_model(path, task):
+    return load_model(path, task,
+                      backend=config.INFERENCE_BACKEND,
+                      int8=config.INFERENCE_INT8,
+                      calibration_dir=config.CALIBRATION_DIR,
+                      calibration_images=config.CALIBRATION_IMAGES)
+
+# Forking server (gunicorn.conf.py): load before the workers are forked so
+# they share the weights. One inference thread keeps the parent from
+# starting a thread pool the children can't inherit, see post_fork.
+def load_models_before_fork():
+    set_inference_threads(1)
+    load_models()
+
+if config.PRELOAD_MODELS:
+    startup.run(load_models_before_fork)
+    if not startup.is_ready:
+        raise RuntimeError(f"Loading models failed: {startup.error}")
+else:
+    startup.start(load_models)
+
+# Endpoints that need the models answer 503 until they're loaded
+def requires_models(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not startup.is_ready:
+            response = jsonify({'success': False, 'message': 'Models are still loading'})
+            response.status_code = 503
+            response.headers['Retry-After'] = '1'
+            return response
+        return f(*args, **kwargs)
+    return decorated
+
+# Images can be posted as a raw body (image/jpeg, image/png, ...), as a
+# multipart upload with an "image" file, or as the original JSON
+# {"image": "<base64>"} form used by older clients.
+def request_image_data():
+    mimetype = request.mimetype
+    if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+        return request.get_data(cache=False)
+    if mimetype == 'multipart/form-data':
+        return request.files['image'].read()
+    with span('base64_decode'):
+        return base64.b64decode(request.json['image'])
+
+def json_response(response):
+    with span('encode'):
+        return jsonify(response)
 
-predictor = Predictor(detection_model, classification_model, color_model, db)
+# Sent with a 503 and Retry-After when admission control turns a request
+# away, and as a message on the detection WebSocket
+def busy_payload(error):
+    return {'success': False, 'busy': True, 'retry_after': error.retry_after,
+            'message': 'Server busy, retry in {}s'.format(error.retry_after)}
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    response = jsonify(busy_payload(error))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+# Live clients identify themselves so per-client state can be kept
+def request_session_id():
+    return request.headers.get('X-Session-Id') or request.args.get('session')
+
+# Saves uploads for load-test.py when RECORD_SESSIONS_DIR is set
+def record_upload(session_id, endpoint, data):
+    if session_recorder is not None:
+        session_recorder.record(session_id, endpoint, data)
+
+@app.before_request
+def start_timer():
+    g.request_started_at = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started_at = g.get('request_started_at')
+    if started_at is not None and request.endpoint:
+        # files keep their file wrapper, they're timed like other responses
+        if response.is_streamed and not response.direct_passthrough:
+            response.response = timed_stream(response.response, started_at, request.endpoint)
+        else:
+            request_seconds.observe(time.perf_counter() - started_at, endpoint=request.endpoint)
+    return response
+
+# Streamed responses are timed until their last chunk is sent
+def timed_stream(chunks, started_at, endpoint):
+    try:
+        yield from chunks
+    finally:
+        request_seconds.observe(time.perf_counter() - started_at, endpoint=endpoint)
 
 @app.route('/')
 def index():
     return app.send_static_file('index.html')
 
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    response = jsonify(startup.report())
+    if not startup.is_ready:
+        response.status_code = 503
+    return response
+
+# The endpoints below are split into the Flask route and a Flask-free
+# *_upload function, which asgi.py runs too. Those take read_data, a
+# zero-arg function returning the uploaded bytes, so that a bad upload
+# is reported the same way as a failure further in.
+
 @app.route('/classes', methods=['GET'])
+@requires_models
 def get_classes():
-    print(list(classification_model.names.values()))
-    return jsonify({'classes': list(classification_model.names.values())})
+    return jsonify(class_names())
+
+def class_names():
+    return {'classes': list(classification_model.names.values())}
 
 # For data capture
 @app.route('/capture', methods=['POST'])
+@requires_models
 def capture():
+    return json_response(capture_upload(request_image_data, request_session_id()))
+
+def capture_upload(read_data, session_id):
+    artifacts = debug_artifacts.begin()
     try:
-        encoded_image = request.json['image']
-        image_bytes = base64.b64decode(encoded_image)
-        image = Image.open(BytesIO(image_bytes))
-        format = image.format.lower()
-
-        image.convert("RGB").save(f'tmp/last-capture-original.{format}')
-
-        image = correct_image_orientation(image)
-
-        print("Looking for Aruco markers...")
-        marker_set = ArucoMarkerSet.detect_from_image(image)
-
-        print("Looking for Lego pieces...")
-        pieces = predictor.detect_objects(image)
-
-        print("Calculating cropping box...")
-        min_x = min([piece.x1 for piece in pieces])
-        max_x = max([piece.x2 for piece in pieces])
-        min_y = min([piece.y1 for piece in pieces])
-        max_y = max([piece.y2 for piece in pieces])
-        cropping_box = BoundingBox(min_x, min_y, max_x, max_y)
-        cropping_box = cropping_box.grow(max(image.width, image.height)*0.025)
-        for marker in marker_set.markers:
-            cropping_box = cropping_box.shrink_from(marker.bounding_box.grow(marker.bounding_box.width*0.1))
-
-        print("Detecting colors...")
-        actual_color = None
-        piece_colors = []
-        if marker_set.valid:
-            actual_color = lego_colors_by_id[marker_set.color_id]
-
-            for piece in pieces:
-                predicted_color, confidence = predictor.predict_color(piece.crop(image))
-                piece_colors.append((piece, predicted_color, confidence))
-
-
-        print("Drawing results...")
-        image_copy = image.copy()
-        draw = ImageDraw.Draw(image_copy)
-        marker_set.draw(draw, color='red', width=5)
-        cropping_box.draw(draw, color='green', width=5)
-        if not actual_color is None:
-            for piece, predicted_color, confidence in piece_colors:
-                if not piece.is_inside(cropping_box):
-                    continue
-
-                correct = predicted_color == actual_color
-                piece.draw(draw, color='white', width=10)
-                piece.draw_label(draw, f"{confidence * 100:.0f}%: {predicted_color.name} ({predicted_color.id})",
-                                text_color = 'black' if correct else 'red',
-                                swatch_color=predicted_color.hex())
-
-        image_copy.convert("RGB").save(f'tmp/last-capture-detect.{format}')
-
-        print("Saving processed file...")
-        cropped_image = cropping_box.crop(image)
-        color_name = re.sub(r'\W+', '', actual_color.name)
-        hash = compute_image_hash(cropped_image)
-        new_filename = f"tmp/colors/{color_name}-{hash[:6]}.{actual_color.id}.{format}"
-        cropped_image.save(new_filename)
-
-        response = {
-            'success': actual_color is not None,
-            'filename': new_filename,
-        }
+        data = read_data()
+        record_upload(session_id, 'capture', data)
+        with admission.admit('capture'):
+            return capture_image(data, artifacts)
 
-        return jsonify(response)
+    except Overloaded:
+        raise
 
     except Exception as e:
-        traceback.print_exc()
-        response = {'success': False, 'message': 'Error processing image: {}'.format(str(e))}
-        return jsonify(response)
+        artifacts.error = e
+        logger.exception("Capture failed")
+        return {'success': False, 'message': 'Error processing image: {}'.format(str(e))}
+
+    finally:
+        debug_artifacts.submit(artifacts)
+
+def capture_image(data, artifacts):
+    image = open_image(data)
+    format = image.format.lower()
+
+    artifacts.add(f'last-capture-original.{format}', image)
+
+    image = orient(image)
+    frame = Frame.from_image(image)
+
+    logger.debug("Looking for Aruco markers...")
+    with span('aruco'):
+        marker_set = ArucoMarkerSet.detect_from_frame(frame)
+
+    logger.debug("Looking for Lego pieces...")
+    pieces = predictor.detect_objects(frame, artifacts)
+    boxes_per_image.observe(len(pieces), endpoint='capture')
+
+    logger.debug("Calculating cropping box...")
+    cropping_box = pieces.bounds()
+    if cropping_box is None:
+        raise ValueError("No pieces found")
+    cropping_box = cropping_box.grow(max(image.width, image.height)*0.025)
+    for marker in marker_set.markers:
+        cropping_box = cropping_box.shrink_from(marker.bounding_box.grow(marker.bounding_box.width*0.1))
+
+    logger.debug("Detecting colors...")
+    actual_color = None
+    piece_colors = []
+    if marker_set.valid:
+        actual_color = lego_colors_by_id[marker_set.color_id]
+
+        for piece, piece_image in zip(pieces, frame.crops(pieces)):
+            predicted_color, confidence = predictor.predict_color(piece_image)
+            piece_colors.append((piece, predicted_color, confidence))
+
+
+    logger.debug("Drawing results...")
+    image_copy = image.copy()
+    draw = ImageDraw.Draw(image_copy)
+    marker_set.draw(draw, color='red', width=5)
+    cropping_box.draw(draw, color='green', width=5)
+    if not actual_color is None:
+        for piece, predicted_color, confidence in piece_colors:
+            if not piece.is_inside(cropping_box):
+                continue
+
+            correct = predicted_color == actual_color
+            piece.draw(draw, color='white', width=10)
+            piece.draw_label(draw, f"{confidence * 100:.0f}%: {predicted_color.name} ({predicted_color.id})",
+                            text_color = 'black' if correct else 'red',
+                            swatch_color=predicted_color.hex())
+
+    artifacts.add(f'last-capture-detect.{format}', image_copy)
+
+    logger.debug("Saving processed file...")
+    cropped_image = cropping_box.crop(image)
+    color_name = re.sub(r'\W+', '', actual_color.name)
+    hash = compute_image_hash(cropped_image)
+    new_filename = f"tmp/colors/{color_name}-{hash[:6]}.{actual_color.id}.{format}"
+    cropped_image.save(new_filename)
+
+    return {
+        'success': actual_color is not None,
+        'filename': new_filename,
+    }
 
 
 @app.route('/detect', methods=['POST'])
+@requires_models
 def detect():
+    return json_response(detect_upload(request_image_data, request_session_id()))
+
+def detect_upload(read_data, session_id):
+    artifacts = debug_artifacts.begin()
     try:
-        encoded_image = request.json['image']
-        image_bytes = base64.b64decode(encoded_image)
-        image = Image.open(BytesIO(image_bytes))
-
-        image.convert("RGB").save('tmp/last-detect-original.png')
-
-        results = detection_model(image.convert("RGB"))
-        boxes = []
-        if len(results) > 0:
-            boxes = [BoundingBox.from_yolo(yolo_box)
-                     for yolo_box in results[0].cpu().boxes]
-            Image.fromarray(
-                results[0].cpu().plot()[..., ::-1]
-            ).save('tmp/last-detect-detection.png')
-
-        response = {
-            'boxes': [{"x": box.x, "y": box.y, "w": box.width, "h": box.height, "valid": not box.is_touching_frame(image.width, image.height)} for box in boxes]
-        }
-        print("---")
-        print(response)
+        data = read_data()
+        record_upload(session_id, 'detect', data)
+        response = detect_frame(data, sessions.get(session_id) if session_id else None, artifacts)
+        logger.debug("Detected %s", response)
+        return response
 
-        return jsonify(response)
+    except Overloaded:
+        raise
 
     except Exception as e:
+        artifacts.error = e
+        logger.exception("Detection failed")
         # If there was an error processing the image, return an error message
-        response = {'success': False,
-                    'message': 'Error processing image: {}'.format(str(e))}
-        return jsonify(response, default=decimal_default)
+        return {'success': False,
+                'message': 'Error processing image: {}'.format(str(e))}
+
+    finally:
+        debug_artifacts.submit(artifacts)
+
+# Live detection over a WebSocket. The client sends binary frames and gets
+# one JSON box update (same shape as /detect) per processed frame. Frames
+# that arrive while the model is busy replace each other, so only the
+# newest is processed and stale ones are dropped rather than queued.
+@sock.route('/detect/stream')
+def detect_stream(ws):
+    if not startup.ready.wait(timeout=30):
+        ws.close(reason=1013, message='Models are still loading')
+        return
+
+    session = sessions.get(request.args.get('session') or str(uuid.uuid4()))
+    frames = LatestValue()
+    threading.Thread(target=receive_frames, args=(ws, frames), daemon=True).start()
+
+    while True:
+        data = frames.take()
+        if data is None:
+            break
+
+        record_upload(session.id, 'detect', data)
+        artifacts = debug_artifacts.begin()
+        try:
+            response = detect_frame(data, session, artifacts)
+        except Overloaded as e:
+            response = busy_payload(e)
+        except Exception as e:
+            artifacts.error = e
+            logger.exception("Streamed detection failed")
+            response = {'success': False,
+                        'message': 'Error processing image: {}'.format(str(e))}
+        finally:
+            debug_artifacts.submit(artifacts)
+
+        try:
+            with span('encode'):
+                message = json.dumps(response)
+            ws.send(message)
+        except ConnectionClosed:
+            break
+
+    frames.close()
+
+def receive_frames(ws, frames):
+    try:
+        while True:
+            data = ws.receive()
+            # text messages are reserved for control, only images are frames
+            if isinstance(data, (bytes, bytearray)):
+                frames.put(data)
+    except ConnectionClosed:
+        pass
+    finally:
+        frames.close()
+
+def detect_frame(data, session, artifacts):
+    # only frames that reach the model count against admission control
+    def run(ingested):
+        with admission.admit('detect'):
+            return detect_boxes(ingested, detection_model, artifacts)
+
+    # only real model results are cached, never the boxes the gate reuses
+    # from a session's previous frame
+    key = cache_key('detect', model_version, data)
+    if session is None:
+        return result_cache.get_or_compute(key, lambda: run(ingest(data, config.MAX_INPUT_PIXELS)))
+
+    ingested = ingest(data, config.MAX_INPUT_PIXELS)
+    # the gate compares the same reduced decode detection runs on
+    image = ingested.reduced(model_input_size(detection_model))
+    response = session.gate.run(image, lambda image: result_cache.get_or_compute(key, lambda: run(ingested)))
+    return track_boxes(response, session.tracker)
 
 @app.route('/classify', methods=['POST'])
+@requires_models
 def classify():
-    # try:
-    encoded_image = request.json['image']
-    image_bytes = base64.b64decode(encoded_image)
-    image = Image.open(BytesIO(image_bytes))
-    print(f"----- format: {image.format}")
-    image = correct_image_orientation(image)
-
-    image.convert("RGB").save('tmp/last-classify-original.jpeg')
-
-    boxes = predictor.detect_objects(image)
-    boxes = boxes[:15] # sorted by size desc, limit predictions b/c slow
-
-    objects = []
-    for box in boxes:
-        # TODO: square after cropping to avoid snagging other parts
-        box_image = box.square().crop(image)
-        parts = predictor.predict_parts_and_colors(box_image)
-        objects.append({
-        'source_url': image_to_data_url(box_image.convert("RGB")),
-        'parts': parts,
-    })
+    return json_response(classify_upload(request_image_data, request_session_id(), request.args.get('color-id')))
+
+def classify_upload(read_data, session_id, color_id):
+    artifacts = debug_artifacts.begin()
+    try:
+        return classify_image(read_data(), session_id, color_id, artifacts)
+    except Overloaded:
+        raise
+    except Exception as e:
+        artifacts.error = e
+        raise
+    finally:
+        debug_artifacts.submit(artifacts)
 
-    color_id = request.args.get('color-id')
-    print(f" ---  color_id: {color_id}")
-    print(f" ---  color_id: {request.args}")
-    print(f" ---  color_id: {request.args.keys()}")
+def classify_image(data, session_id, color_id, artifacts):
+    # try:
+    record_upload(session_id, 'classify', data)
+    session = sessions.get(session_id) if session_id else None
+    def compute(tracker=None):
+        with admission.admit('classify'):
+            if classification_pipeline is not None:
+                job = ClassifyJob(ingest(data, config.MAX_INPUT_PIXELS), artifacts, tracker)
+                return classification_pipeline.run(job).response()
+            return classify_objects(ingest(data, config.MAX_INPUT_PIXELS), predictor, crop_store, artifacts,
+                                    tracker=tracker)
+
+    if session is not None:
+        # the session's tracker already caches pieces it has classified
+        response = compute(session.tracker)
+    else:
+        response = result_cache.get_or_compute(cache_key('classify', model_version, data), compute,
+                                               validate=crops_available)
+
+    save_color_sample(data, color_id)
+
+    return response
+
+# ?color-id= saves the shot as training data for the color model
+def save_color_sample(data, color_id):
+    logger.debug("color_id: %s", color_id)
     if not color_id is None:
+        image = orient(open_image(data))
         color = lego_colors_by_id[int(color_id)]
         os.makedirs(f'tmp/colors/{color.id}', exist_ok=True)
         image.convert("RGB").save(f'tmp/colors/{color.id}/{color.name.replace(" ", "")}-{str(uuid.uuid4())[:6]}.{color.id}.jpeg')
 
-    response = {
-        'objects': objects
-    }
-    print("--- response:")
-    r = response.copy()
-    # r['source_url'] = r['source_url'][:15] + "..."
-    # print(r)
-
-    return jsonify(response)
-
     # except Exception as e:
     #     # If there was an error processing the image, return an error message
     #     response = {'success': False,
     #                 'message': 'Error processing image: {}'.format(str(e))}
     #     return jsonify(response)
 
-@app.teardown_appcontext
-def close_connection(exception):
-    db.close()
+# Same as /classify but as newline-delimited JSON: the detected boxes
+# first, then one object per piece as soon as it has been classified.
+# Objects carry the index of their box, they can arrive out of order.
+@app.route('/classify/stream', methods=['POST'])
+@requires_models
+def classify_stream():
+    slot, lines = classify_stream_upload(request_image_data(), request_session_id(), request.args.get('color-id'))
+    response = Response(stream_with_context(lines), mimetype='application/x-ndjson', headers=STREAM_HEADERS)
+    # a response that's closed before the generator started
+    response.call_on_close(slot.release)
+    return response
+
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Admitted before answering so an overloaded server can still send a 503.
+# The slot is released once the returned lines are done; not every server
+# closes the response, so the generator releases it too and callers should
+# also release it when the response goes away before it started.
+def classify_stream_upload(data, session_id, color_id, slot=None):
+    record_upload(session_id, 'classify', data)
+    session = sessions.get(session_id) if session_id else None
+    slot = slot or admission.slot('classify')
+    return slot, classify_stream_lines(data, session, color_id, slot)
+
+# The /classify/stream body, one JSON line per event. Releases the
+# admission slot once it's done.
+def classify_stream_lines(data, session, color_id, slot):
+    artifacts = debug_artifacts.begin()
+    try:
+        ingested = ingest(data, config.MAX_INPUT_PIXELS)
+        tracker = session.tracker if session else None
+        if classification_pipeline is not None:
+            events = pipeline_events(ClassifyJob(ingested, artifacts, tracker, progressive=True))
+        else:
+            events = classify_events(ingested, predictor, crop_store, artifacts, tracker=tracker, progressive=True)
+        for event in events:
+            yield json.dumps(event, default=decimal_default) + '\n'
+        # like /classify, only shots that classified become training data
+        save_color_sample(data, color_id)
+        yield json.dumps({'type': 'done'}) + '\n'
+    except Exception as e:
+        artifacts.error = e
+        logger.exception("Streamed classification failed")
+        yield json.dumps({'type': 'error', 'message': 'Error processing image: {}'.format(str(e))}) + '\n'
+    finally:
+        slot.release()
+        debug_artifacts.submit(artifacts)
+
+# Runs a job through the classification pipeline, yielding its events as
+# the stages produce them
+def pipeline_events(job):
+    events = queue.Queue()
+    job.on_event = events.put
+    running = classification_pipeline.submit(job, on_done=lambda _: events.put(None))
+    deadline = time.monotonic() + config.PIPELINE_TIMEOUT
+    while True:
+        try:
+            event = events.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise TimeoutError(f"Classification not done after {config.PIPELINE_TIMEOUT}s")
+        if event is None:
+            break
+        yield event
+    # raises what failed the job, if anything did
+    running.wait(0)
+
+# A cached response is only usable while all of its crops can still be served
+def crops_available(response):
+    return all(crop_key(o['source_url']) in crop_store for o in response['objects'])
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'detect_gate': sessions.gate_stats.to_dict(),
+        'sessions': len(sessions),
+        'result_cache': result_cache.stats(),
+        'debug_artifacts': debug_artifacts.stats(),
+        'admission': admission.to_dict(),
+        'pipeline': classification_pipeline.to_dict() if classification_pipeline else {},
+        'scheduler': {model.name: model.to_dict()
+                      for model in (detection_model, classification_model, color_model)
+                      if isinstance(model, BatchingModel)},
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+registry.counter_callback(
+    'lego_cache_requests_total', 'Cache lookups by cache and outcome', ['cache', 'result'],
+    lambda: {
+        ('result', 'hit'): result_cache.hits,
+        ('result', 'disk_hit'): result_cache.disk_hits,
+        ('result', 'miss'): result_cache.misses,
+        ('result', 'coalesced'): result_cache.coalesced,
+        ('detect_gate', 'hit'): sessions.gate_stats.hits,
+        ('detect_gate', 'miss'): sessions.gate_stats.misses,
+    })
+registry.gauge_callback(
+    'lego_inference_queue_depth', 'Images waiting for a batch, per model', ['model'],
+    lambda: {(model.name,): model.queue_depth
+             for model in (detection_model, classification_model, color_model)
+             if isinstance(model, BatchingModel)})
+registry.counter_callback(
+    'lego_debug_artifacts_total', 'Debug artifacts by outcome', ['result'],
+    lambda: {
+        ('written',): debug_artifacts.written,
+        ('dropped',): debug_artifacts.dropped,
+        ('failed',): debug_artifacts.failed,
+    })
+registry.gauge_callback(
+    'lego_pipeline_queue_depth', 'Requests waiting for each /classify pipeline stage', ['stage'],
+    lambda: {(stage.name,): stage.queue_depth
+             for stage in (classification_pipeline.stages if classification_pipeline else [])})
+registry.gauge_callback(
+    'lego_pipeline_utilization', 'Share of worker time each /classify pipeline stage spends working', ['stage'],
+    lambda: {(name,): stats['utilization']
+             for name, stats in (classification_pipeline.to_dict() if classification_pipeline else {}).items()})
+registry.gauge_callback(
+    'lego_admission_requests', 'Requests holding or waiting for an inference slot', ['endpoint', 'state'],
+    lambda: {(endpoint, state): stats[state]
+             for endpoint, stats in admission.to_dict().items()
+             for state in ('running', 'queued')})
+registry.counter_callback(
+    'lego_admission_rejected_total', 'Requests turned away with a 503, per endpoint', ['endpoint'],
+    lambda: {(endpoint,): stats['rejected'] for endpoint, stats in admission.to_dict().items()})
+
+# Crops are content addressed so they can be cached forever
+@app.route('/crops/<key>', methods=['GET'])
+def get_crop(key):
+    if not re.fullmatch(r'[0-9a-f]+', key):
+        abort(404)
+    data = crop_store.get(key)
+    if data is None:
+        abort(404)
+
+    response = make_response(data)
+    response.mimetype = crop_store.mimetype
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(key)
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
-    print("-----------")
     for rule in app.url_map.iter_rules():
         methods = ','.join(sorted(rule.methods))
-        print(f"{rule} ({methods})")
+        logger.info(f"{rule} ({methods})")
     app.run(port=8000, debug=True)
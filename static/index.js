@@ -25,23 +25,48 @@
   let crop = { x: 0, y: 0, width: 300, height: 300 };
   let captureMode = false;
 
+  // Live frames are sent at the model's input resolution as JPEG blobs.
+  // Shots for /classify and /capture stay lossless PNG since they are
+  // saved as color training data.
+  const modelInputSize = 224;
+  const frameQuality = 0.92;
+
+  // Lets the server skip detection on frames that haven't changed
+  const sessionId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : Math.random().toString(36).slice(2);
+
+  // Live detection streams frames over a WebSocket when possible and
+  // falls back to posting frames to /detect one at a time
+  const streamFrameInterval = 100;
+  let detectionSocket = null;
+  let detectionLoopRunning = false;
+
+  // When the server is busy it says how long to wait; live detection backs
+  // off for that long, doubling up to maxBusyBackoff while it stays busy
+  const maxBusyBackoff = 30000;
+  let busyUntil = 0;
+  let busyBackoff = 0;
+
+  function backOff(retryAfterSeconds) {
+    busyBackoff = Math.min(maxBusyBackoff, Math.max((retryAfterSeconds || 1) * 1000, busyBackoff * 2));
+    busyUntil = Date.now() + busyBackoff;
+  }
+
+  function waitUntilNotBusy() {
+    return new Promise(resolve => setTimeout(resolve, Math.max(0, busyUntil - Date.now())));
+  }
+
   function startup() {
     var myInput = document.getElementById('myFileInput');
 
     function sendPic(event) {
       if (event.target.files && event.target.files[0]) {
-        const reader = new FileReader();
-        reader.onload = async (e) => {
-          const dataUrl = e.target.result;
-          const base64Image = dataUrl.replace(/^data:image\/(png|jpg|jpeg);base64,/, "");
-          if (captureMode) {
-            capture(base64Image)
-          } else {
-            classify(base64Image);
-          }
-
+        // a File is a Blob, send the original bytes as-is (keeps EXIF orientation)
+        const file = event.target.files[0];
+        if (captureMode) {
+          capture(file)
+        } else {
+          classify(file);
         }
-        reader.readAsDataURL(event.target.files[0]);
       }
     }
     myInput.addEventListener('change', sendPic, false);
@@ -59,8 +84,8 @@
 
     photoCanvas = document.getElementById("photo-canvas");
     // match size of image needed for prediction
-    photoCanvas.setAttribute("height", 224);
-    photoCanvas.setAttribute("width", 224);
+    photoCanvas.setAttribute("height", modelInputSize);
+    photoCanvas.setAttribute("width", modelInputSize);
 
     photo = document.getElementById("photo");
     takePhotoButton = document.getElementById("take-photo");
@@ -85,6 +110,16 @@
         previewContext.beginPath();
         previewContext.rect(box.x * widthScaleFactor, box.y * heightScaleFactor, box.w * widthScaleFactor, box.h * heightScaleFactor);
         previewContext.stroke();
+
+        // Pieces already classified in this session come back labeled
+        if (box.parts && box.parts.length > 0) {
+          const part = box.parts[0];
+          previewContext.fillStyle = part.color.hex;
+          previewContext.fillRect(box.x * widthScaleFactor, (box.y + box.h) * heightScaleFactor + 2, 12, 12);
+          previewContext.fillStyle = 'white';
+          previewContext.font = '12px sans-serif';
+          previewContext.fillText(part.id, box.x * widthScaleFactor + 16, (box.y + box.h) * heightScaleFactor + 12);
+        }
       });
       requestAnimationFrame(updatePreviewCanvas);
     }
@@ -122,7 +157,7 @@
         showDetection = showDetectionCheckbox.checked;
         boundingBoxes = [];
         if (showDetection) {
-          detectionLoop();
+          startDetection();
         }
       }
     )
@@ -145,20 +180,84 @@
     clearphoto();
   }
 
+  function startDetection() {
+    if (detectionSocket && detectionSocket.readyState === WebSocket.OPEN) {
+      // toggled back on before the previous stream wound down
+      return;
+    }
+    if (!("WebSocket" in window)) {
+      detectionLoop();
+      return;
+    }
+
+    const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
+    const socket = new WebSocket(`${protocol}//${window.location.host}/detect/stream?session=${sessionId}`);
+
+    socket.onopen = () => {
+      detectionSocket = socket;
+      streamFrames(socket);
+    };
+
+    socket.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.busy) {
+        backOff(data.retry_after);
+        return;
+      }
+      busyBackoff = 0;
+      boundingBoxes = data.boxes || [];
+    };
+
+    socket.onclose = () => {
+      detectionSocket = null;
+      if (showDetection) {
+        console.log("Detection stream unavailable, falling back to /detect");
+        detectionLoop();
+      }
+    };
+  }
+
+  async function streamFrames(socket) {
+    while (showDetection && socket.readyState === WebSocket.OPEN) {
+      await waitUntilNotBusy();
+      // don't pile frames up in the browser, the server only wants the latest
+      if (socket.bufferedAmount === 0) {
+        drawImageScaled2(video, photoCanvas)
+        socket.send(await canvasToBlob(photoCanvas));
+      }
+      await new Promise(resolve => setTimeout(resolve, streamFrameInterval));
+    }
+    if (!showDetection) {
+      socket.onclose = null;
+      socket.close();
+    }
+  }
+
   async function detectionLoop() {
+    if (detectionLoopRunning) {
+      return;
+    }
+    detectionLoopRunning = true;
+    try {
+      await runDetectionLoop();
+    } finally {
+      detectionLoopRunning = false;
+    }
+  }
+
+  async function runDetectionLoop() {
     while (showDetection) {
+      await waitUntilNotBusy();
       drawImageScaled2(video, photoCanvas)
-      const dataUrl = photoCanvas.toDataURL("image/png");
-      const base64_image = dataUrl.replace(/^data:image\/(png|jpg|jpeg);base64,/, "");
+      const frame = await canvasToBlob(photoCanvas);
 
       // detect the image
-      response = await fetch("/detect", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ image: base64_image }),
-      });
+      response = await postImage("/detect", frame, { "X-Session-Id": sessionId });
+      if (response.status === 503) {
+        backOff(parseInt(response.headers.get("Retry-After"), 10));
+        continue;
+      }
+      busyBackoff = 0;
 
       const data = await response.json();
       console.log("Success:", data);
@@ -168,6 +267,22 @@
     }
   }
 
+  function canvasToBlob(canvas, type = "image/jpeg") {
+    return new Promise(resolve => canvas.toBlob(resolve, type, frameQuality));
+  }
+
+  // Post an image Blob as the raw request body
+  function postImage(url, blob, headers = {}) {
+    return fetch(url, {
+      method: "POST",
+      headers: {
+        "Content-Type": blob.type || "application/octet-stream",
+        ...headers,
+      },
+      body: blob,
+    });
+  }
+
   // Fill the photo with an indication that none has been
   // captured.
 
@@ -203,16 +318,10 @@
     // 0, 0, canvas.width, canvas.height);
   }
 
-  function capture(base64_image) {
+  function capture(blob) {
     predictionsContainer.innerHTML = '';
 
-    fetch("/capture" + window.location.search, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({ image: base64_image }),
-    })
+    postImage("/capture" + window.location.search, blob, { "X-Session-Id": sessionId })
       .then((response) => response.json())
       .then((data) => {
         console.log("Success:", data);
@@ -225,64 +334,92 @@
       });
   }
 
-  function classify(base64_image) {
-    predictionsContainer.innerHTML = '';
-
-    // classify the image
-    fetch("/classify" + window.location.search, {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({ image: base64_image }),
+  function renderObject(predictionElement, object) {
+    predictionElement.querySelector('.prediction-source').src = object.source_url;
+
+    object.parts.forEach((part) => {
+      const partElement = predictionPartTemplate.content.cloneNode(true);
+      partElement.querySelector(".prediction-part-image").src = part.url;
+      partElement.querySelector(".prediction-part-id").innerText = part.id;
+      partElement.querySelector(".prediction-part-name").innerText = part.name;
+      partElement.querySelector(".prediction-part-confidence").innerText = Math.round(part.confidence * 100, 0) + "%";
+      partElement.querySelector(".prediction-color-swatch").style.backgroundColor = part.color ? part.color.hex : 'transparent';
+      partElement.querySelector(".prediction-color-name").innerText = part.color ? part.color.name : '';
+      partElement.querySelector(".prediction-color-id").innerText = part.color ? part.color.id : '';
+      partElement.querySelector(".prediction-color-confidence").innerText = part.color ? Math.round(part.color.confidence * 100, 0) + "%" : '';
+
+      predictionElement.querySelector('.prediction-parts').appendChild(partElement);
     })
-      .then((response) => response.json())
-      .then((data) => {
-        console.log("Success:", data);
+  }
 
-        data.objects.forEach((object) => {
-          const predictionElement = predictionTemplate.content.cloneNode(true);
-          predictionElement.querySelector('.prediction-color-border').style.borderColor = 'gray';
-          predictionElement.querySelector('.prediction-source').src = object.source_url;
-
-          object.parts.forEach((part) => {
-            console.log("PART ", part.id);
-            const partElement = predictionPartTemplate.content.cloneNode(true);
-            partElement.querySelector(".prediction-part-image").src = part.url;
-            partElement.querySelector(".prediction-part-id").innerText = part.id;
-            partElement.querySelector(".prediction-part-name").innerText = part.name;
-            partElement.querySelector(".prediction-part-confidence").innerText = Math.round(part.confidence * 100, 0) + "%";
-            partElement.querySelector(".prediction-color-swatch").style.backgroundColor = part.color ? part.color.hex : 'transparent';
-            partElement.querySelector(".prediction-color-name").innerText = part.color ? part.color.name : '';
-            partElement.querySelector(".prediction-color-id").innerText = part.color ? part.color.id : '';
-            partElement.querySelector(".prediction-color-confidence").innerText = part.color ? Math.round(part.color.confidence * 100, 0) + "%" : '';
-
-            predictionElement.querySelector('.prediction-parts').appendChild(partElement);
-          })
-
-          predictionsContainer.appendChild(predictionElement);
-        })
-      })
-      .catch((error) => {
-        console.error("Error:", error);
-        predictionsContainer.innerText = error;
-      });
+  // An empty prediction per detected piece, filled in as results arrive
+  function addPlaceholder() {
+    const fragment = predictionTemplate.content.cloneNode(true);
+    const predictionElement = fragment.firstElementChild;
+    predictionElement.querySelector('.prediction-color-border').style.borderColor = 'gray';
+    predictionsContainer.appendChild(fragment);
+    return predictionElement;
+  }
 
+  // Reads newline-delimited JSON events from /classify/stream
+  async function readEvents(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) {
+        break;
+      }
+      buffered += decoder.decode(value, { stream: true });
+      const lines = buffered.split('\n');
+      buffered = lines.pop();
+      lines.filter((line) => line.trim()).forEach((line) => onEvent(JSON.parse(line)));
+    }
   }
 
-  function takepicture() {
+  async function classify(blob) {
+    predictionsContainer.innerHTML = '';
+
+    // classify the image, pieces show up as soon as each is classified
+    try {
+      const response = await postImage("/classify/stream" + window.location.search, blob, { "X-Session-Id": sessionId });
+      if (response.status === 503) {
+        const retryAfter = response.headers.get("Retry-After") || 1;
+        throw new Error(`The server is busy, try again in ${retryAfter}s`);
+      }
+      if (!response.ok) {
+        throw new Error(`Classification failed: ${response.status}`);
+      }
+      let placeholders = [];
+      await readEvents(response, (event) => {
+        if (event.type === 'boxes') {
+          placeholders = event.boxes.map(() => addPlaceholder());
+        } else if (event.type === 'object') {
+          renderObject(placeholders[event.index], event);
+        } else if (event.type === 'error') {
+          throw new Error(event.message);
+        }
+      });
+    } catch (error) {
+      console.error("Error:", error);
+      predictionsContainer.innerText = error;
+    }
+  }
+
+  async function takepicture() {
     console.log("Taking photo...");
     drawImageScaled2(video, photoCanvas)
-    const data = photoCanvas.toDataURL("image/png");
-    photo.setAttribute("src", data);
-
-    // base64 encode the image
-    const base64_image = data.replace(/^data:image\/(png|jpg);base64,/, "");
+    const blob = await canvasToBlob(photoCanvas, "image/png");
+    if (photo.src.startsWith("blob:")) {
+      URL.revokeObjectURL(photo.src);
+    }
+    photo.setAttribute("src", URL.createObjectURL(blob));
 
     if (captureMode) {
-      capture(base64_image)
+      capture(blob)
     } else {
-      classify(base64_image);
+      classify(blob);
     }
   }
 